@@ -0,0 +1,116 @@
+import json
+import time
+import asyncio
+import logging
+import threading
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Streaming server on asyncio: every viewer is a socket plus a small stats dict instead of an OS thread.
+# Frames are pushed to all viewers with non-blocking transport writes; a viewer whose unsent data
+# is already above client_buffer_bytes skips frames until its socket catches up
+class AsyncStreamingServer:
+    def __init__(self, output, page, address=('', 7123), max_viewers=64, client_buffer_bytes=256 * 1024):
+        self.output = output
+        self.page = page.encode('utf-8')
+        self.host, self.port = address
+        self.max_viewers = max_viewers
+        self.client_buffer_bytes = client_buffer_bytes
+        self.viewers = {}
+        self.loop = None
+
+    # Function to run the server until cancelled
+    async def serve_forever(self):
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.handle_client, self.host or None, self.port, reuse_address=True)
+        threading.Thread(target=self.pump_frames, daemon=True).start()
+        logger.info(f"Async streaming server listening on port {self.port}")
+        async with server:
+            await server.serve_forever()
+
+    # Function to run the server in a background thread with its own event loop
+    def start_in_thread(self):
+        thread = threading.Thread(target=asyncio.run, args=(self.serve_forever(),), daemon=True)
+        thread.start()
+        return thread
+
+    # Thread that waits for camera frames and hands each one to the event loop
+    def pump_frames(self):
+        last_sequence = self.output.sequence
+        while True:
+            sequence, frame = self.output.wait_for_frame(last_sequence, timeout=5)
+            if frame is None:
+                continue
+            last_sequence = sequence
+            self.loop.call_soon_threadsafe(self.broadcast, frame)
+
+    # Function to queue a frame on every viewer's socket without waiting for any of them
+    def broadcast(self, frame):
+        header = f"--FRAME\r\nContent-Type: image/jpeg\r\nContent-Length: {len(frame)}\r\n\r\n".encode('ascii')
+        for writer, stats in list(self.viewers.items()):
+            transport = writer.transport
+            if transport.is_closing():
+                continue
+            if transport.get_write_buffer_size() > self.client_buffer_bytes:
+                stats['frames_dropped'] += 1
+                continue
+            transport.writelines((header, frame, b'\r\n'))
+            stats['frames_sent'] += 1
+
+    # Function to write a complete, non-streaming HTTP response
+    async def send_response(self, writer, status, content_type, content, extra_headers=()):
+        headers = [f"HTTP/1.0 {status}", f"Content-Type: {content_type}", f"Content-Length: {len(content)}", *extra_headers]
+        writer.write(("\r\n".join(headers) + "\r\n\r\n").encode('ascii') + content)
+        await writer.drain()
+
+    # Function to serve one HTTP connection
+    async def handle_client(self, reader, writer):
+        client_address = writer.get_extra_info('peername')
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=10)
+            parts = request.split(b'\r\n', 1)[0].decode('latin-1').split()
+            path = parts[1] if len(parts) >= 2 else ''
+
+            if path == '/':
+                await self.send_response(writer, "301 Moved Permanently", "text/html", b'', ["Location: /index.html"])
+            elif path == '/index.html':
+                await self.send_response(writer, "200 OK", "text/html", self.page)
+            elif path == '/stats':
+                stats = {s['client']: s for s in self.viewers.values()}
+                await self.send_response(writer, "200 OK", "application/json", json.dumps(stats).encode('utf-8'))
+            elif path == '/metrics':
+                content = metrics.REGISTRY.render_prometheus().encode('utf-8')
+                await self.send_response(writer, "200 OK", "text/plain; version=0.0.4", content)
+            elif path == '/stream.mjpg':
+                await self.stream(reader, writer, client_address)
+            else:
+                await self.send_response(writer, "404 Not Found", "text/plain", b'Not Found')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError) as e:
+            logger.debug(f"Dropped request from {client_address}: {e}")
+        finally:
+            writer.close()
+
+    # Function to register a viewer and keep it registered until its connection closes
+    async def stream(self, reader, writer, client_address):
+        if len(self.viewers) >= self.max_viewers:
+            await self.send_response(writer, "503 Service Unavailable", "text/plain", b'Too many viewers')
+            return
+
+        writer.write(
+            b"HTTP/1.0 200 OK\r\n"
+            b"Age: 0\r\n"
+            b"Cache-Control: no-cache, private\r\n"
+            b"Pragma: no-cache\r\n"
+            b"Content-Type: multipart/x-mixed-replace; boundary=FRAME\r\n\r\n"
+        )
+        stats = {'client': f"{client_address[0]}:{client_address[1]}", 'connected': time.time(),
+                 'frames_sent': 0, 'frames_dropped': 0}
+        self.viewers[writer] = stats
+        try:
+            # Viewers never send anything after the request, so this returns when they disconnect
+            await reader.read()
+        finally:
+            del self.viewers[writer]
+            logger.info(f"Streaming client {client_address} sent {stats['frames_sent']} frames, "
+                        f"dropped {stats['frames_dropped']}")
@@ -0,0 +1,275 @@
+import os
+import io
+import json
+import time
+import random
+import resource
+import platform
+import argparse
+import tempfile
+from datetime import datetime
+from PIL import Image, ImageDraw
+import numpy as np
+import image_processing
+from database import DatabasePool
+from tray_layout import TrayLayout
+
+# Benchmark results are written here as JSON, one file per run
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks")
+
+# Function to draw one synthetic tray photo with eggs at known cells
+# Returns the JPEG bytes and the ground truth as {(row, column): status} with 1-based cells
+def make_tray_image(rng, layout, size, fill_ratio=0.85):
+    width, height = size
+    image = Image.new("RGB", size, (18, 14, 10))  # Dark candling background
+    draw = ImageDraw.Draw(image)
+    cell_width = width / layout.columns
+    cell_height = height / layout.rows
+
+    truth = {}
+    for row in range(layout.rows):
+        for col in range(layout.columns):
+            if rng.random() > fill_ratio:
+                continue
+            center_x = (col + 0.5 + rng.uniform(-0.1, 0.1)) * cell_width
+            center_y = (row + 0.5 + rng.uniform(-0.1, 0.1)) * cell_height
+            radius_x = cell_width * 0.32
+            radius_y = cell_height * 0.4
+            draw.ellipse(
+                [center_x - radius_x, center_y - radius_y, center_x + radius_x, center_y + radius_y],
+                fill=(235, 170, 90)
+            )
+            status = "fertile" if rng.random() < 0.7 else "infertile"
+            if status == "fertile":
+                # Dark embryo shadow in the middle of a fertile egg
+                draw.ellipse(
+                    [center_x - radius_x * 0.4, center_y - radius_y * 0.3,
+                     center_x + radius_x * 0.4, center_y + radius_y * 0.3],
+                    fill=(120, 40, 25)
+                )
+            truth[(row + 1, col + 1)] = status
+
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG", quality=90)
+    return buffered.getvalue(), truth
+
+# Function to create the images/fertility_status tables in the SQLite stand-in and fill images
+def create_stand_in_database(db, images):
+    def create(connection):
+        cursor = connection.cursor()
+        try:
+            cursor.execute("DROP TABLE IF EXISTS images")
+            cursor.execute("DROP TABLE IF EXISTS fertility_status")
+            cursor.execute("CREATE TABLE images (id INTEGER PRIMARY KEY, image_data BLOB, detection_Date TEXT, incubatorNo TEXT)")
+            cursor.execute("""
+                CREATE TABLE fertility_status (
+                    id INTEGER PRIMARY KEY, image_id INTEGER, `row_number` INTEGER, column_number INTEGER,
+                    status TEXT, confidence REAL, detection_date TEXT, incubatorNo TEXT
+                )
+            """)
+            cursor.executemany(
+                "INSERT INTO images (id, image_data, detection_Date) VALUES (%s, %s, %s)",
+                [(image_id, image_data, datetime.now().isoformat()) for image_id, image_data in images]
+            )
+            connection.commit()
+        finally:
+            cursor.close()
+
+    db.run(create)
+    image_processing.ensure_result_unique_key(db)
+    image_processing.ensure_processed_images_table(db)
+
+# Function to empty fertility_status and processed_images between benchmark phases
+def clear_results(db):
+    def clear(connection):
+        cursor = connection.cursor()
+        try:
+            cursor.execute("DELETE FROM fertility_status")
+            cursor.execute("DELETE FROM processed_images")
+            connection.commit()
+        finally:
+            cursor.close()
+
+    db.run(clear)
+
+# Function to get the peak resident set size of this process in MB
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if platform.system() == "Darwin" else peak / 1024
+
+# Function to compute a percentile of the samples with linear interpolation
+def percentile(samples, q):
+    ordered = sorted(samples)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+# Function to summarise latency samples (seconds) as milliseconds plus throughput
+def summarize(samples):
+    if not samples:
+        return {"count": 0}
+    total = sum(samples)
+    return {
+        "count": len(samples),
+        "mean_ms": round(total / len(samples) * 1000, 3),
+        "p50_ms": round(percentile(samples, 50) * 1000, 3),
+        "p95_ms": round(percentile(samples, 95) * 1000, 3),
+        "p99_ms": round(percentile(samples, 99) * 1000, 3),
+        "per_second": round(len(samples) / total, 2) if total > 0 else None,
+    }
+
+# Function to time decode, inference, grid mapping and saving separately for every image
+def benchmark_stages(model, db, images, layout):
+    timings = {"decode": [], "predict": [], "grid_mapping": [], "save": [], "process_image": []}
+    truth_cells = 0
+    found_cells = 0
+    correct_status = 0
+
+    for image_id, image_data, truth in images:
+        started = time.perf_counter()
+        image = image_processing.decode_image(image_id, image_data)
+        decoded = time.perf_counter()
+        results = image_processing.predict_image(model, image_processing.model_input(image))
+        image_processing.release_image(image)
+        predicted = time.perf_counter()
+        egg_data = image_processing.map_results_to_grid(image_id, results or [], image.size, None, layout,
+                                                        getattr(image, "letterbox", None))
+        mapped = time.perf_counter()
+        image_processing.save_results_to_database(db, egg_data)
+        saved = time.perf_counter()
+
+        timings["decode"].append(decoded - started)
+        timings["predict"].append(predicted - decoded)
+        timings["grid_mapping"].append(mapped - predicted)
+        timings["save"].append(saved - mapped)
+        timings["process_image"].append(mapped - started)
+
+        truth_cells += len(truth)
+        for _, row, col, status, _, _ in egg_data:
+            if (row, col) in truth:
+                found_cells += 1
+                correct_status += truth[(row, col)] == status
+
+    accuracy = {
+        "eggs": truth_cells,
+        "cells_found": found_cells,
+        "status_correct": correct_status,
+        "recall": round(found_cells / truth_cells, 4) if truth_cells else None,
+    }
+    return {name: summarize(samples) for name, samples in timings.items()}, accuracy
+
+# Function to time grid mapping alone on synthetic boxes, independent of what the model detects
+def benchmark_grid_mapping(layout, size, boxes_per_image=56, repeats=2000):
+    rng = np.random.default_rng(0)
+    width, height = size
+    centers = rng.uniform([0, 0], [width, height], size=(boxes_per_image, 2))
+    half = np.array([width / layout.columns, height / layout.rows]) * 0.35
+    xyxy = np.hstack([centers - half, centers + half])
+    conf = rng.uniform(0.3, 1.0, boxes_per_image)
+    cls = rng.integers(0, 2, boxes_per_image)
+
+    samples = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        layout.assign(xyxy, conf, cls, size)
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+# Function to print the change of every p50/p95/p99 against an earlier results file
+def compare_results(current, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"Compared with {baseline_path}:")
+    for stage, summary in current["stages"].items():
+        previous = baseline.get("stages", {}).get(stage, {})
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            if key in summary and previous.get(key):
+                change = (summary[key] - previous[key]) / previous[key] * 100
+                print(f"  {stage:<14} {key}: {previous[key]:.2f} -> {summary[key]:.2f} ms ({change:+.1f}%)")
+    if baseline.get("pipeline", {}).get("images_per_second"):
+        print(f"  pipeline images/s: {baseline['pipeline']['images_per_second']} -> "
+              f"{current['pipeline']['images_per_second']}")
+
+# Main function to generate the synthetic data set, run every benchmark and store the results
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the egg-detection pipeline on synthetic tray images")
+    parser.add_argument("--model", default=image_processing.MODEL_PATH, help="YOLO checkpoint to benchmark")
+    parser.add_argument("--backend", default=image_processing.MODEL_BACKEND, help="inference backend for load_model")
+    parser.add_argument("--images", type=int, default=100, help="number of synthetic tray images")
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=960)
+    parser.add_argument("--rows", type=int, default=7)
+    parser.add_argument("--columns", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", default=None, help="results file (default: benchmarks/<timestamp>.json)")
+    parser.add_argument("--compare", default=None, help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    layout = TrayLayout(args.rows, args.columns)
+    size = (args.width, args.height)
+
+    started = time.perf_counter()
+    images = []
+    for image_id in range(1, args.images + 1):
+        image_data, truth = make_tray_image(rng, layout, size)
+        images.append((image_id, image_data, truth))
+    print(f"Generated {len(images)} synthetic tray images in {time.perf_counter() - started:.1f}s")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db = DatabasePool(backend="sqlite", sqlite_path=os.path.join(temp_dir, "benchmark.sqlite3"))
+        create_stand_in_database(db, [(image_id, image_data) for image_id, image_data, _ in images])
+
+        started = time.perf_counter()
+        model = image_processing.load_model(args.model, backend=args.backend)
+        load_seconds = time.perf_counter() - started
+        if model is None:
+            return
+
+        stages, accuracy = benchmark_stages(model, db, images, layout)
+        stages["grid_mapping_synthetic"] = benchmark_grid_mapping(layout, size)
+
+        clear_results(db)
+        started = time.perf_counter()
+        image_processing.run_pipeline(model, db)
+        pipeline_seconds = time.perf_counter() - started
+        db.close()
+
+    results = {
+        "timestamp": datetime.now().isoformat(),
+        "host": platform.node(),
+        "machine": platform.machine(),
+        "python": platform.python_version(),
+        "model": args.model,
+        "backend": args.backend,
+        "settings": {
+            "images": args.images,
+            "image_size": list(size),
+            "tray": [args.rows, args.columns],
+            "batch_size": image_processing.BATCH_SIZE,
+            "decode_workers": image_processing.DECODE_WORKERS,
+            "seed": args.seed,
+        },
+        "load_model_s": round(load_seconds, 3),
+        "stages": stages,
+        "pipeline": {
+            "seconds": round(pipeline_seconds, 3),
+            "images_per_second": round(args.images / pipeline_seconds, 2) if pipeline_seconds > 0 else None,
+        },
+        "accuracy": accuracy,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(json.dumps(results, indent=2))
+    print(f"Results saved to {output}")
+    if args.compare:
+        compare_results(results, args.compare)
+
+if __name__ == "__main__":
+    main()
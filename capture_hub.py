@@ -0,0 +1,342 @@
+import io
+import os
+import time
+import struct
+import signal
+import argparse
+import logging
+import threading
+from multiprocessing import shared_memory, resource_tracker
+import cv2
+import numpy as np
+from config import get_setting
+
+logger = logging.getLogger(__name__)
+
+# Capture hub: one process owns the camera (or a synthetic / video-file source) and publishes every
+# JPEG frame into a shared-memory ring, so the MJPEG server, the RTMP stream, the still capture and
+# the upload loop can all read the same frames at once. Start it before the consumers and set
+# use_hub = true for them; they then never open the camera themselves
+USE_HUB = get_setting("hub", "use_hub", False, bool)
+HUB_NAME = get_setting("hub", "hub_name", "intelliegg_frames")
+HUB_SLOTS = get_setting("hub", "hub_slots", 8, int)
+HUB_SLOT_BYTES = get_setting("hub", "hub_slot_bytes", 1024 * 1024, int)
+HUB_SOURCE = get_setting("hub", "hub_source", "camera")
+HUB_VIDEO_PATH = get_setting("hub", "hub_video_path", "")
+HUB_FPS = get_setting("hub", "hub_fps", 30, int)
+HUB_WIDTH = get_setting("hub", "hub_width", 640, int)
+HUB_HEIGHT = get_setting("hub", "hub_height", 480, int)
+HUB_JPEG_QUALITY = get_setting("hub", "hub_jpeg_quality", 85, int)
+# A ring whose hub process has exited, or whose heartbeat is older than hub_stale_after seconds, is
+# taken over by a new hub; a live ring makes the new hub refuse to start
+HUB_STALE_AFTER = get_setting("hub", "hub_stale_after", 10.0, float)
+
+# Ring layout: a header (magic, slot count, slot size, latest sequence, then the hub's pid and
+# heartbeat time) followed by the slots. Each slot starts with a seqlock version, which is odd while the slot is being written, then the
+# frame's sequence number, capture time and length, then the JPEG bytes
+MAGIC = b"EGGHUB1\0"
+HEADER = struct.Struct("<8sIIQ")
+HEADER_SIZE = 64
+SLOT_HEADER = struct.Struct("<QQdI")
+SLOT_HEADER_SIZE = 32
+LATEST_OFFSET = 16
+OWNER = struct.Struct("<Qd")
+OWNER_OFFSET = 24
+HEARTBEAT_INTERVAL = 1.0
+
+def slot_offset(slot, slot_bytes):
+    return HEADER_SIZE + slot * (SLOT_HEADER_SIZE + slot_bytes)
+
+# Function to check whether a process with the given pid is running
+def process_alive(pid):
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # Running, but owned by another user
+    return True
+
+# Function to unlink an existing ring of the given name if its hub is gone
+# Raises RuntimeError when another hub is still publishing to it
+def remove_stale_ring(name, stale_after=HUB_STALE_AFTER):
+    try:
+        existing = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    try:
+        magic, pid, heartbeat = None, 0, 0.0
+        if existing.size >= HEADER_SIZE:
+            magic = HEADER.unpack_from(existing.buf, 0)[0]
+            pid, heartbeat = OWNER.unpack_from(existing.buf, OWNER_OFFSET)
+        if magic != MAGIC:
+            raise RuntimeError(f"Shared memory {name} exists and is not a capture hub frame ring")
+        age = time.time() - heartbeat
+        if process_alive(pid) and age < stale_after:
+            raise RuntimeError(f"Capture hub {pid} is still publishing to {name} (heartbeat {age:.1f}s ago)")
+        existing.unlink()
+        logger.warning(f"Removed stale frame ring {name} (hub {pid}, heartbeat {age:.0f}s ago)")
+    finally:
+        existing.close()
+
+# Writer side of the ring; also usable as a picamera2 FileOutput target
+class HubPublisher(io.BufferedIOBase):
+    def __init__(self, name=HUB_NAME, slots=HUB_SLOTS, slot_bytes=HUB_SLOT_BYTES):
+        size = HEADER_SIZE + slots * (SLOT_HEADER_SIZE + slot_bytes)
+        remove_stale_ring(name)  # A segment left behind by a crashed hub would otherwise block the name
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.buf = self.shm.buf
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.sequence = 0
+        self.frames_oversized = 0
+        HEADER.pack_into(self.buf, 0, MAGIC, slots, slot_bytes, 0)
+        OWNER.pack_into(self.buf, OWNER_OFFSET, os.getpid(), time.time())
+        # The heartbeat keeps going while the source is idle, so a stalled camera is not mistaken for a dead hub
+        self.stop_heartbeat = threading.Event()
+        self.heartbeat_thread = threading.Thread(target=self.heartbeat, daemon=True)
+        self.heartbeat_thread.start()
+
+    # Function to refresh the heartbeat time in the header until the publisher is closed
+    def heartbeat(self):
+        while not self.stop_heartbeat.wait(HEARTBEAT_INTERVAL):
+            struct.pack_into("<d", self.buf, OWNER_OFFSET + 8, time.time())
+
+    # Function to publish one JPEG frame; frames larger than a slot are skipped
+    def publish(self, frame):
+        length = len(frame)
+        if length > self.slot_bytes:
+            self.frames_oversized += 1
+            logger.warning(f"Skipped a {length} byte frame, larger than hub_slot_bytes ({self.slot_bytes})")
+            return
+        self.sequence += 1
+        offset = slot_offset(self.sequence % self.slots, self.slot_bytes)
+        version = struct.unpack_from("<Q", self.buf, offset)[0]
+        struct.pack_into("<Q", self.buf, offset, version + 1)
+        data_offset = offset + SLOT_HEADER_SIZE
+        self.buf[data_offset:data_offset + length] = frame
+        SLOT_HEADER.pack_into(self.buf, offset, version + 1, self.sequence, time.time(), length)
+        struct.pack_into("<Q", self.buf, offset, version + 2)  # Even again: the slot is consistent
+        struct.pack_into("<Q", self.buf, LATEST_OFFSET, self.sequence)
+
+    def write(self, buf):
+        self.publish(buf)
+        return len(buf)
+
+    def close(self):
+        self.stop_heartbeat.set()
+        self.heartbeat_thread.join()
+        self.buf = None
+        self.shm.close()
+        self.shm.unlink()
+
+# Reader side of the ring, with the same wait_for_frame interface as StreamingOutput
+# Readers never block the hub: a slot that is rewritten while it is being copied is simply read again.
+# Waiting readers sleep until the next frame is due, going by the hub's recent frame interval, and
+# back off to max_poll_interval while the hub is idle, instead of polling every few milliseconds
+class HubReader:
+    def __init__(self, name=HUB_NAME, attach_timeout=30.0, poll_interval=0.002, max_poll_interval=0.1):
+        deadline = time.monotonic() + attach_timeout
+        while True:
+            try:
+                self.shm = shared_memory.SharedMemory(name=name)
+                break
+            except FileNotFoundError:
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.5)  # The hub may still be starting
+        try:
+            # Only the hub owns the segment; stop this process's tracker from unlinking it on exit
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+        except Exception:
+            pass
+        self.buf = self.shm.buf
+        magic, self.slots, self.slot_bytes, _ = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC:
+            raise ValueError(f"Shared memory {name} is not a capture hub frame ring")
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.last_sequence = 0
+        self.last_frame_time = 0.0
+        self.frame_interval = 0.0
+
+    @property
+    def sequence(self):
+        return struct.unpack_from("<Q", self.buf, LATEST_OFFSET)[0]
+
+    # Function to copy the frame in the slot of the given sequence, returning (sequence, frame) or None
+    def read_slot(self, sequence, retries=5):
+        offset = slot_offset(sequence % self.slots, self.slot_bytes)
+        data_offset = offset + SLOT_HEADER_SIZE
+        for _ in range(retries):
+            version, frame_sequence, frame_time, length = SLOT_HEADER.unpack_from(self.buf, offset)
+            if version % 2:
+                time.sleep(0)  # Mid-write; let the hub finish
+                continue
+            frame = bytes(self.buf[data_offset:data_offset + length])
+            if struct.unpack_from("<Q", self.buf, offset)[0] == version:
+                self.track_frame_time(frame_sequence, frame_time)
+                return frame_sequence, frame
+        return None
+
+    # Function to keep a moving average of the time between the hub's frames
+    def track_frame_time(self, sequence, frame_time):
+        if self.last_sequence and sequence > self.last_sequence and frame_time > self.last_frame_time:
+            interval = (frame_time - self.last_frame_time) / (sequence - self.last_sequence)
+            self.frame_interval = interval if not self.frame_interval else 0.8 * self.frame_interval + 0.2 * interval
+        if sequence > self.last_sequence:
+            self.last_sequence = sequence
+            self.last_frame_time = frame_time
+
+    # Function to get how long to sleep before looking at the ring again, after idle_polls empty looks
+    def poll_delay(self, idle_polls):
+        if self.frame_interval:
+            due = self.last_frame_time + self.frame_interval - time.time()
+            if due > self.poll_interval:
+                return min(due, self.max_poll_interval)
+        return min(self.poll_interval * 2 ** min(idle_polls, 10), self.max_poll_interval)
+
+    # Function to get the newest frame as (sequence, frame), or (0, None) before the first frame
+    def latest(self):
+        sequence = self.sequence
+        if sequence == 0:
+            return 0, None
+        return self.read_slot(sequence) or (sequence, None)
+
+    # Function to wait for a frame newer than last_sequence
+    # Returns (sequence, frame), or (last_sequence, None) on timeout; always the newest frame
+    def wait_for_frame(self, last_sequence, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        idle_polls = 0
+        while True:
+            sequence = self.sequence
+            if sequence != last_sequence and sequence:
+                result = self.read_slot(sequence)
+                if result:
+                    return result
+            delay = self.poll_delay(idle_polls)
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return last_sequence, None
+                delay = min(delay, remaining)
+            time.sleep(delay)
+            idle_polls += 1
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+# Source publishing the camera's hardware JPEG stream
+class CameraSource:
+    def __init__(self, size, fps):
+        from picamera2 import Picamera2
+        self.picam2 = Picamera2()
+        self.picam2.configure(self.picam2.create_video_configuration(main={"size": size}, controls={"FrameRate": fps}))
+
+    def run(self, publisher, stop_event):
+        from picamera2.encoders import JpegEncoder
+        from picamera2.outputs import FileOutput
+        self.picam2.start_recording(JpegEncoder(), FileOutput(publisher))
+        try:
+            stop_event.wait()
+        finally:
+            self.picam2.stop_recording()
+
+# Base for sources that produce BGR images in Python; encodes and paces them to fps
+class PacedSource:
+    def __init__(self, size, fps, quality=HUB_JPEG_QUALITY):
+        self.size = size
+        self.fps = fps
+        self.quality = quality
+
+    def run(self, publisher, stop_event):
+        interval = 1.0 / self.fps
+        next_frame = time.monotonic()
+        while not stop_event.is_set():
+            image = self.next_image()
+            if image is None:
+                break
+            ok, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            if ok:
+                publisher.publish(jpeg)
+            next_frame += interval
+            stop_event.wait(max(0.0, next_frame - time.monotonic()))
+
+# Source generating a moving test pattern, for running the streaming stack without a camera
+class SyntheticSource(PacedSource):
+    def __init__(self, size, fps, quality=HUB_JPEG_QUALITY):
+        super().__init__(size, fps, quality)
+        width, height = size
+        gradient = np.linspace(40, 200, width, dtype=np.uint8)
+        self.background = np.dstack([np.tile(gradient, (height, 1))] * 3)
+        self.frame_number = 0
+
+    def next_image(self):
+        width, height = self.size
+        image = self.background.copy()
+        x = (self.frame_number * 4) % width
+        cv2.rectangle(image, (x, height // 3), (min(x + 60, width - 1), height // 3 + 60), (0, 200, 255), -1)
+        cv2.putText(image, f"{self.frame_number} {time.strftime('%H:%M:%S')}", (10, height - 20),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2)
+        self.frame_number += 1
+        return image
+
+# Source replaying a video file in a loop at fps
+class VideoFileSource(PacedSource):
+    def __init__(self, path, size, fps, quality=HUB_JPEG_QUALITY):
+        super().__init__(size, fps, quality)
+        self.capture = cv2.VideoCapture(path)
+        if not self.capture.isOpened():
+            raise RuntimeError(f"Cannot open video file {path}")
+
+    def next_image(self):
+        ok, image = self.capture.read()
+        if not ok:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ok, image = self.capture.read()
+            if not ok:
+                return None
+        if (image.shape[1], image.shape[0]) != self.size:
+            image = cv2.resize(image, self.size, interpolation=cv2.INTER_AREA)
+        return image
+
+# Function to build the configured frame source
+def create_source(source, size, fps, video_path=HUB_VIDEO_PATH):
+    if source == "synthetic":
+        return SyntheticSource(size, fps)
+    if source == "video":
+        return VideoFileSource(video_path, size, fps)
+    return CameraSource(size, fps)
+
+def main():
+    parser = argparse.ArgumentParser(description="Own the camera and share its JPEG frames with the streaming scripts")
+    parser.add_argument("--source", choices=["camera", "synthetic", "video"], default=HUB_SOURCE)
+    parser.add_argument("--video", default=HUB_VIDEO_PATH, help="video file for --source video")
+    parser.add_argument("--fps", type=int, default=HUB_FPS)
+    parser.add_argument("--width", type=int, default=HUB_WIDTH)
+    parser.add_argument("--height", type=int, default=HUB_HEIGHT)
+    parser.add_argument("--name", default=HUB_NAME)
+    parser.add_argument("--slots", type=int, default=HUB_SLOTS)
+    parser.add_argument("--slot-bytes", type=int, default=HUB_SLOT_BYTES)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda sig, frame: stop_event.set())
+
+    source = create_source(args.source, (args.width, args.height), args.fps, args.video)
+    publisher = HubPublisher(args.name, args.slots, args.slot_bytes)
+    logger.info(f"Publishing {args.source} frames to {args.name} ({args.slots} x {args.slot_bytes} bytes)")
+    try:
+        source.run(publisher, stop_event)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info(f"Published {publisher.sequence} frames")
+        publisher.close()
+
+if __name__ == "__main__":
+    main()
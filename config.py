@@ -0,0 +1,34 @@
+import os
+import configparser
+
+# Settings are read from this INI file; see intelliegg.ini.example for the available keys
+CONFIG_PATH = os.environ.get(
+    "INTELLIEGG_CONFIG",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "intelliegg.ini")
+)
+
+_parser = None
+
+# Function to load the INI file once, returning an empty config when it does not exist
+def load_config(path=CONFIG_PATH):
+    global _parser
+    if _parser is None:
+        parser = configparser.ConfigParser()
+        try:
+            parser.read(path)
+        except configparser.Error as e:
+            print(f"Error reading config file {path}: {str(e)}")
+        _parser = parser
+    return _parser
+
+# Function to look up a setting: the INTELLIEGG_<KEY> environment variable wins,
+# then [section] key in the config file, then the given default
+def get_setting(section, key, default=None, cast=str):
+    value = os.environ.get(f"INTELLIEGG_{key.upper()}")
+    if value is None:
+        value = load_config().get(section, key, fallback=None)
+    if value is None:
+        return default
+    if cast is bool:
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return cast(value)
@@ -0,0 +1,203 @@
+import time
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from mysql.connector import Error, errors, pooling
+from config import get_setting
+
+# Connection settings; "sqlite" runs against a local file instead of the MySQL server
+DB_BACKEND = get_setting("database", "db_backend", "mysql")
+DB_HOST = get_setting("database", "db_host", "192.168.0.101")
+DB_PORT = get_setting("database", "db_port", 3306, int)
+DB_USER = get_setting("database", "db_user", "root")
+DB_PASSWORD = get_setting("database", "db_password", "")
+DB_NAME = get_setting("database", "db_name", "intelliegg")
+DB_SQLITE_PATH = get_setting("database", "db_sqlite_path", "intelliegg.sqlite3")
+
+# Pool size and reconnect behaviour: retries back off exponentially from DB_RETRY_DELAY up to DB_RETRY_MAX_DELAY
+DB_POOL_SIZE = get_setting("database", "db_pool_size", 4, int)
+DB_MAX_RETRIES = get_setting("database", "db_max_retries", 6, int)
+DB_RETRY_DELAY = get_setting("database", "db_retry_delay", 0.5, float)
+DB_RETRY_MAX_DELAY = get_setting("database", "db_retry_max_delay", 30.0, float)
+
+# Errors that mean the link to the server dropped or the pool is busy, as opposed to a bad statement
+TRANSIENT_ERRORS = (errors.OperationalError, errors.InterfaceError, errors.PoolError)
+
+# Function to turn a sqlite3 error into the matching mysql.connector error
+# Only a locked or busy database is transient; other operational errors ("no such table", syntax
+# errors) would fail the same way on every retry, so they become ProgrammingError
+def translate_sqlite_error(error):
+    message = str(error)
+    if isinstance(error, sqlite3.OperationalError):
+        if "locked" in message or "busy" in message:
+            return errors.OperationalError(msg=message)
+        return errors.ProgrammingError(msg=message)
+    if isinstance(error, sqlite3.IntegrityError):
+        return errors.IntegrityError(msg=message)
+    return errors.DatabaseError(msg=message)
+
+# Cursor for the SQLite stand-in that accepts the %s placeholders used by the MySQL queries
+class SQLiteCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, params=()):
+        try:
+            self.cursor.execute(sql.replace("%s", "?"), tuple(params))
+        except sqlite3.Error as e:
+            raise translate_sqlite_error(e)
+
+    def executemany(self, sql, seq_params):
+        try:
+            self.cursor.executemany(sql.replace("%s", "?"), [tuple(p) for p in seq_params])
+        except sqlite3.Error as e:
+            raise translate_sqlite_error(e)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+# Connection for the SQLite stand-in, mirroring the parts of the MySQL connection API used here
+class SQLiteConnection:
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+
+    def cursor(self, buffered=None, **kwargs):
+        return SQLiteCursor(self.connection.cursor())
+
+    def ping(self, reconnect=False, attempts=1, delay=0):
+        self.connection.execute("SELECT 1")
+
+    def is_connected(self):
+        return True
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        self.connection.close()
+
+# Shared pool of database connections with health checks and reconnect/retry
+# Any thread may call run() or use connection(); each call checks out its own connection
+class DatabasePool:
+    def __init__(self, backend=DB_BACKEND, pool_size=DB_POOL_SIZE, max_retries=DB_MAX_RETRIES,
+                 retry_delay=DB_RETRY_DELAY, retry_max_delay=DB_RETRY_MAX_DELAY, sqlite_path=DB_SQLITE_PATH):
+        self.dialect = backend
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.retry_max_delay = retry_max_delay
+        self.sqlite_path = sqlite_path
+        self.lock = threading.Lock()
+        self.mysql_pool = None
+        self.sqlite_connections = queue.LifoQueue()
+
+    # Function to create the MySQL pool on first use, so a server that is down at startup can be retried
+    def _get_mysql_pool(self):
+        with self.lock:
+            if self.mysql_pool is None:
+                self.mysql_pool = pooling.MySQLConnectionPool(
+                    pool_name="intelliegg",
+                    pool_size=self.pool_size,
+                    pool_reset_session=True,
+                    host=DB_HOST,
+                    port=DB_PORT,
+                    user=DB_USER,
+                    password=DB_PASSWORD,
+                    database=DB_NAME,
+                    autocommit=False
+                )
+                print(f"Connected to database {DB_NAME} on {DB_HOST}:{DB_PORT} (pool of {self.pool_size})")
+            return self.mysql_pool
+
+    # Function to check out one healthy connection
+    def _checkout(self):
+        if self.dialect == "sqlite":
+            try:
+                return self.sqlite_connections.get_nowait()
+            except queue.Empty:
+                return SQLiteConnection(self.sqlite_path)
+
+        connection = self._get_mysql_pool().get_connection()
+        try:
+            # Health check; re-opens the underlying socket if the server dropped it while idle
+            connection.ping(reconnect=True, attempts=1, delay=0)
+        except Error:
+            connection.close()
+            raise
+        return connection
+
+    # Function to hand a connection back to the pool
+    def _release(self, connection):
+        if self.dialect == "sqlite":
+            self.sqlite_connections.put(connection)
+        else:
+            connection.close()  # Returns a pooled connection to the pool
+
+    # Function to sleep before retry number attempt, doubling the delay each time
+    def _backoff(self, attempt, error):
+        delay = min(self.retry_delay * (2 ** attempt), self.retry_max_delay)
+        print(f"Database unavailable ({str(error)}), retrying in {delay:.1f}s")
+        time.sleep(delay)
+
+    # Context manager giving a healthy connection, waiting with exponential backoff while the server is unreachable
+    @contextmanager
+    def connection(self):
+        for attempt in range(self.max_retries + 1):
+            try:
+                connection = self._checkout()
+                break
+            except TRANSIENT_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                self._backoff(attempt, e)
+        try:
+            yield connection
+        except Exception:
+            try:
+                connection.rollback()
+            except Error:
+                pass
+            raise
+        finally:
+            self._release(connection)
+
+    # Function to run fn(connection, *args) and return its result
+    # Idempotent statements are retried on a fresh connection when the link drops mid-call. Checkout
+    # failures are not retried here: connection() has already backed off and given up on those
+    def run(self, fn, *args, idempotent=True):
+        attempt = 0
+        while True:
+            checked_out = False
+            try:
+                with self.connection() as connection:
+                    checked_out = True
+                    return fn(connection, *args)
+            except TRANSIENT_ERRORS as e:
+                if not checked_out or not idempotent or attempt >= self.max_retries:
+                    raise
+                self._backoff(attempt, e)
+                attempt += 1
+
+    # Function to check that the database can be reached at all
+    def is_healthy(self):
+        try:
+            with self.connection() as connection:
+                connection.ping()
+            return True
+        except Error as e:
+            print(f"Error connecting to database: {str(e)}")
+            return False
+
+    # Function to close all idle connections
+    def close(self):
+        while not self.sqlite_connections.empty():
+            self.sqlite_connections.get_nowait().close()
+        if self.mysql_pool is not None:
+            self.mysql_pool._remove_connections()
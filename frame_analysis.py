@@ -0,0 +1,78 @@
+import time
+import cv2
+import numpy as np
+
+# Size of the grayscale thumbnail that frames are compared at
+THUMBNAIL_SIZE = (32, 24)
+
+# Function to decode a JPEG straight to a small grayscale thumbnail
+# IMREAD_REDUCED_GRAYSCALE_8 lets libjpeg decode at 1/8 scale in the DCT domain, so a full-size
+# decode never happens; the result is then area-averaged down to THUMBNAIL_SIZE
+def jpeg_thumbnail(jpeg, size=THUMBNAIL_SIZE):
+    gray = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if gray is None:
+        return None
+    return cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+
+# Decides whether a frame differs enough from the last uploaded one to be worth uploading
+# The score is the mean absolute difference between thumbnails in gray levels (0-255). Frames are
+# compared against the last *uploaded* frame, so slow drift still triggers an upload eventually,
+# and a heartbeat upload is forced when nothing was sent for heartbeat_interval seconds
+class ChangeDetector:
+    def __init__(self, threshold=6.0, heartbeat_interval=900.0, size=THUMBNAIL_SIZE):
+        self.threshold = threshold
+        self.heartbeat_interval = heartbeat_interval
+        self.size = size
+        self.reference = None
+        self.last_upload = None
+
+    # Function to check a JPEG frame; returns (should_upload, reason, score, thumbnail)
+    def check(self, jpeg):
+        thumbnail = jpeg_thumbnail(jpeg, self.size)
+        if thumbnail is None:
+            return True, "undecodable", None, None
+        if self.reference is None:
+            return True, "first frame", None, thumbnail
+
+        score = float(cv2.absdiff(thumbnail, self.reference).mean())
+        if score >= self.threshold:
+            return True, "changed", score, thumbnail
+        if time.monotonic() - self.last_upload >= self.heartbeat_interval:
+            return True, "heartbeat", score, thumbnail
+        return False, "unchanged", score, thumbnail
+
+    # Function to record that the frame with this thumbnail was uploaded successfully
+    def mark_uploaded(self, thumbnail):
+        if thumbnail is not None:
+            self.reference = thumbnail
+        self.last_upload = time.monotonic()
+
+# Function to score how usable a grayscale frame is, returning (sharpness, exposure)
+# Sharpness is the variance of the Laplacian (blur and motion lower it); exposure is 1.0 for a
+# mid-gray mean with no clipped pixels and falls towards 0 for dark, blown-out or clipped frames
+def frame_quality(gray):
+    sharpness = float(cv2.Laplacian(gray, cv2.CV_32F).var())
+    mean = float(gray.mean())
+    clipped = float(np.count_nonzero((gray <= 5) | (gray >= 250))) / gray.size
+    exposure = max(0.0, 1.0 - abs(mean - 128.0) / 128.0 - clipped)
+    return sharpness, exposure
+
+# Function to score an encoded frame; decoded at 1/2 scale, which keeps enough detail for sharpness
+def jpeg_quality(jpeg):
+    gray = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_2)
+    if gray is None:
+        return None
+    return frame_quality(gray)
+
+# Function to pick the best of a burst from their (sharpness, exposure) scores, or None if none scored
+# Frames are ranked by sharpness weighted by exposure, so a sharp but badly exposed frame loses
+def pick_best_frame(scores):
+    best_index = None
+    best_value = None
+    for index, score in enumerate(scores):
+        if score is None:
+            continue
+        sharpness, exposure = score
+        if best_value is None or sharpness * exposure > best_value:
+            best_index, best_value = index, sharpness * exposure
+    return best_index
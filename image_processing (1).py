@@ -1,31 +1,155 @@
 import os
-import io
 import base64
 import requests
-from PIL import Image
 import numpy as np
 import cv2
 import supervision as sv
 import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from roboflow import Roboflow
+from config import get_setting
+from inference_cache import InferenceCache, image_hash, file_hash
 
-# Function to connect to the Roboflow API and load the model
-def load_roboflow_model(api_key, project_id, model_version):
+# Roboflow project and the PHP endpoints the results go through
+# The API key has no default; set [roboflow] api_key in intelliegg.ini
+API_KEY_PLACEHOLDER = "YOUR_ROBOFLOW_API_KEY"
+API_KEY = get_setting("roboflow", "api_key", "")
+PROJECT_ID = get_setting("roboflow", "project_id", "egg-candling-v1.0")
+MODEL_VERSION = get_setting("roboflow", "model_version", 1, int)
+FETCH_URL = get_setting("roboflow", "fetch_url", "http://intelliegg.site/webpages/fetch_data.php")
+INSERT_URL = get_setting("roboflow", "insert_url", "http://intelliegg.site/webpages/insert_data.php")
+CONFIDENCE = get_setting("roboflow", "confidence", 40, int)
+OVERLAP = get_setting("roboflow", "overlap", 30, int)
+
+# Images are scored by INFERENCE_WORKERS threads against the hosted API. A request slower than
+# HOSTED_TIMEOUT seconds, or any API error, sends the image to the local YOLO model instead and
+# keeps the API bypassed for HOSTED_RETRY_AFTER seconds
+HOSTED_URL = get_setting("roboflow", "hosted_url", "https://detect.roboflow.com")
+INFERENCE_WORKERS = get_setting("roboflow", "inference_workers", 4, int)
+HOSTED_TIMEOUT = get_setting("roboflow", "hosted_timeout", 10.0, float)
+HOSTED_RETRY_AFTER = get_setting("roboflow", "hosted_retry_after", 120.0, float)
+LOCAL_FALLBACK = get_setting("roboflow", "local_fallback", True, bool)
+LOCAL_MODEL_PATH = get_setting(
+    "processing", "model_path",
+    "/home/pi/aws-computer-vision-industrial-egg-fertility-sorting-system/egg_detection_yolov8n_final.pt"
+)
+
+# Predictions are cached by image content hash and model version, so re-runs skip inference
+CACHE_PATH = get_setting("roboflow", "cache_path", "inference_cache.sqlite3")
+CACHE_MAX_BYTES = get_setting("roboflow", "cache_max_bytes", 50 * 1024 * 1024, int)
+
+# Annotated output: images wider than ANNOTATED_MAX_WIDTH are shrunk (0 keeps the original size),
+# then JPEG-encoded once at ANNOTATED_JPEG_QUALITY. A copy is kept in ANNOTATED_DIR only if SAVE_ANNOTATED
+ANNOTATED_MAX_WIDTH = get_setting("roboflow", "annotated_max_width", 0, int)
+ANNOTATED_JPEG_QUALITY = get_setting("roboflow", "annotated_jpeg_quality", 85, int)
+SAVE_ANNOTATED = get_setting("roboflow", "save_annotated", True, bool)
+ANNOTATED_DIR = get_setting("roboflow", "annotated_dir", ".")
+
+# Annotators are created once and shared by every image
+BOX_ANNOTATOR = sv.BoxAnnotator()
+LABEL_ANNOTATOR = sv.LabelAnnotator()
+
+# One requests.Session per worker thread, each reusing its keep-alive connections
+thread_state = threading.local()
+
+# Function to get the calling thread's HTTP session
+def get_session():
+    if not hasattr(thread_state, "session"):
+        thread_state.session = requests.Session()
+    return thread_state.session
+
+# Function to get the cache version of the local model from its file hash, or None when the file is missing
+# Known up front, so results the local model cached on an earlier run are found before the model is loaded
+def local_model_version(path):
     try:
-        rf = Roboflow(api_key=api_key)
-        project = rf.workspace().project(project_id)
-        model = project.version(model_version).model
-        print(f"Roboflow model loaded successfully from project {project_id} version {model_version}")
-        return model
-    except Exception as e:
-        print(f"Error loading Roboflow model: {str(e)}")
+        return f"local:{file_hash(path)[:16]}"
+    except OSError as e:
+        print(f"Local model {path} unavailable: {str(e)}")
         return None
 
+# Runs predictions on the hosted Roboflow API with the local YOLO model as fallback, caching every result
+class InferenceClient:
+    def __init__(self, api_key=API_KEY, project_id=PROJECT_ID, model_version=MODEL_VERSION, cache=None):
+        self.url = f"{HOSTED_URL}/{project_id}/{model_version}"
+        self.params = {"api_key": api_key, "confidence": CONFIDENCE, "overlap": OVERLAP}
+        self.hosted_version = f"roboflow:{project_id}/{model_version}"
+        self.local_version = local_model_version(LOCAL_MODEL_PATH) if LOCAL_FALLBACK else None
+        self.cache = cache
+        self.hosted_down_until = 0
+        self.local_model = None
+        self.local_lock = threading.Lock()
+
+    # Function to post one JPEG to the hosted API over this thread's session
+    def predict_hosted(self, image_bytes):
+        response = get_session().post(
+            self.url,
+            params=self.params,
+            data=base64.b64encode(image_bytes),
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+            timeout=HOSTED_TIMEOUT
+        )
+        response.raise_for_status()
+        return response.json()["predictions"]
+
+    # Function to load the local YOLO model once, on the first fallback
+    def get_local_model(self):
+        with self.local_lock:
+            if self.local_model is None:
+                from image_processing import load_model
+                self.local_model = load_model(LOCAL_MODEL_PATH)
+            return self.local_model
+
+    # Function to run the local YOLO model, returning predictions in the hosted API's format
+    def predict_local(self, image_cv2):
+        model = self.get_local_model()
+        if model is None:
+            raise RuntimeError("local model unavailable")
+        with self.local_lock:  # One inference at a time; the model is not thread-safe
+            results = model(image_cv2, conf=CONFIDENCE / 100, iou=OVERLAP / 100)
+        predictions = []
+        for xyxy, confidence, class_id in zip(results[0].boxes.xyxy.tolist(), results[0].boxes.conf.tolist(),
+                                              results[0].boxes.cls.tolist()):
+            x1, y1, x2, y2 = xyxy
+            predictions.append({
+                "x": (x1 + x2) / 2, "y": (y1 + y2) / 2, "width": x2 - x1, "height": y2 - y1,
+                "confidence": confidence, "class": "FER" if int(class_id) == 0 else "INF"
+            })
+        return predictions
+
+    # Function to get the predictions for an image: from the cache, the hosted API, or the local model
+    def predict(self, image_id, image_bytes, image_cv2):
+        key = image_hash(image_bytes)
+        if self.cache is not None:
+            for version in (self.hosted_version, self.local_version):
+                cached = self.cache.get(key, version) if version else None
+                if cached is not None:
+                    print(f"Using cached predictions for image {image_id} ({version})")
+                    return cached
+
+        predictions, version = None, None
+        if time.monotonic() >= self.hosted_down_until:
+            try:
+                predictions, version = self.predict_hosted(image_bytes), self.hosted_version
+            except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                print(f"Hosted inference failed for image {image_id}: {str(e)}")
+                self.hosted_down_until = time.monotonic() + HOSTED_RETRY_AFTER
+        if predictions is None:
+            if not LOCAL_FALLBACK:
+                return None
+            predictions = self.predict_local(image_cv2)
+            version = self.local_version
+            print(f"Image {image_id} scored with the local model")
+
+        if self.cache is not None:
+            self.cache.put(key, version, predictions)
+        return predictions
+
 # Function to fetch unprocessed images from the PHP script
 def get_unprocessed_images(url):
     try:
-        response = requests.get(url)
+        response = get_session().get(url)
         response.raise_for_status()
         response_data = response.json()
         
@@ -45,22 +169,24 @@ def get_unprocessed_images(url):
         return []
 
 # Function to process the image, detect eggs, and determine their positions and status
-def process_image(model, image_id, image_data, detection_date):
+def process_image(client, image_id, image_data, detection_date):
     try:
-        # Decode base64 image data
+        # Decode base64 image data straight into the BGR array OpenCV and supervision work on
         image_data = base64.b64decode(image_data)
-        image = Image.open(io.BytesIO(image_data)).convert("RGB")
+        image_cv2 = cv2.imdecode(np.frombuffer(image_data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image_cv2 is None:
+            raise ValueError("not a decodable image")
         print(f"Image {image_id} opened successfully")
     except Exception as e:
         print(f"Error opening image {image_id}: {str(e)}")
         return None, None
 
-    # Convert PIL image to OpenCV format
-    image_np = np.array(image)
-    image_cv2 = cv2.cvtColor(image_np, cv2.COLOR_RGB2BGR)
-
-    # Run prediction using the Roboflow model
-    result = model.predict(image_cv2, confidence=40, overlap=30).json()
+    # Run prediction using the Roboflow model (or the cache / local fallback)
+    try:
+        result = {'predictions': client.predict(image_id, image_data, image_cv2)}
+    except Exception as e:
+        print(f"Error predicting image {image_id}: {str(e)}")
+        return None, None
     print("Raw predictions:", result['predictions'])  # Debug: Print raw predictions
 
     if not result['predictions']:
@@ -85,9 +211,15 @@ def process_image(model, image_id, image_data, detection_date):
     # Debug: Print number of predictions
     print(f"Number of predictions: {len(result['predictions'])}")
 
+    # Shrink the image before annotating if it is wider than the configured output width
+    scale = 1.0
+    if ANNOTATED_MAX_WIDTH and image_cv2.shape[1] > ANNOTATED_MAX_WIDTH:
+        scale = ANNOTATED_MAX_WIDTH / image_cv2.shape[1]
+        image_cv2 = cv2.resize(image_cv2, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
     # Create Detections object
     detections = sv.Detections(
-        xyxy=np.array(xyxy),
+        xyxy=np.array(xyxy, dtype=np.float32) * scale,
         confidence=np.array(confidence),
         class_id=np.array(class_id)
     )
@@ -95,28 +227,27 @@ def process_image(model, image_id, image_data, detection_date):
     # Debug: Print number of detections
     print(f"Number of detections: {len(detections.xyxy)}")
 
-    # Annotate the image with bounding boxes and labels
-    label_annotator = sv.LabelAnnotator()
-    bounding_box_annotator = sv.BoxAnnotator()
-
     # Step 1: Draw bounding boxes
-    annotated_image = bounding_box_annotator.annotate(scene=image_cv2, detections=detections)
+    annotated_image = BOX_ANNOTATOR.annotate(scene=image_cv2, detections=detections)
 
     # Step 2: Add labels
-    annotated_image = label_annotator.annotate(scene=annotated_image, detections=detections, labels=labels)
+    annotated_image = LABEL_ANNOTATOR.annotate(scene=annotated_image, detections=detections, labels=labels)
 
-    # Convert annotated image back to PIL format
-    annotated_image_pil = Image.fromarray(cv2.cvtColor(annotated_image, cv2.COLOR_BGR2RGB))
+    # Encode the annotated image once; the same JPEG bytes are saved to disk and uploaded
+    ok, annotated_jpeg = cv2.imencode('.jpg', annotated_image, [cv2.IMWRITE_JPEG_QUALITY, ANNOTATED_JPEG_QUALITY])
+    if not ok:
+        print(f"Error encoding annotated image {image_id}")
+        return None, None
 
     # Save the annotated image
-    annotated_image_path = f"annotated_image_{image_id}.jpg"
-    annotated_image_pil.save(annotated_image_path)
-    print(f"Annotated image saved to {annotated_image_path}")
+    if SAVE_ANNOTATED:
+        annotated_image_path = os.path.join(ANNOTATED_DIR, f"annotated_image_{image_id}.jpg")
+        with open(annotated_image_path, "wb") as f:
+            f.write(annotated_jpeg)
+        print(f"Annotated image saved to {annotated_image_path}")
 
     # Convert annotated image to base64
-    buffered = io.BytesIO()
-    annotated_image_pil.save(buffered, format="JPEG")
-    annotated_image_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
+    annotated_image_base64 = base64.b64encode(annotated_jpeg).decode('utf-8')
 
     return annotated_image_base64, detection_date
 
@@ -129,7 +260,7 @@ def save_results_to_php(url, annotated_image_base64, detection_date):
         }
 
         headers = {'Content-Type': 'application/json'}
-        response = requests.post(url, data=json.dumps(data), headers=headers)
+        response = get_session().post(url, data=json.dumps(data), headers=headers)
         print("PHP response content:", response.text)  # Print the raw response from PHP for debugging
         response.raise_for_status()
         response_data = response.json()
@@ -143,39 +274,44 @@ def save_results_to_php(url, annotated_image_base64, detection_date):
     except json.JSONDecodeError as e:
         print(f"Error decoding JSON response: {str(e)} - Response content: {response.text}")
 
+# Function to process one image and save its results, run on the worker threads
+def process_and_save(client, image):
+    image_id = image['id']
+    image_data = image['image_data']
+    detection_date = image['detection_Date']
+
+    # Process the image and annotate it
+    annotated_image_base64, detection_date = process_image(client, image_id, image_data, detection_date)
+    if annotated_image_base64:
+        # Save the results to the database
+        save_results_to_php(INSERT_URL, annotated_image_base64, detection_date)
+        print(f"Processed and saved image {image_id}")
+    else:
+        print(f"No eggs detected in image {image_id}")
+
 # Main function
 def main():
-    api_key = "sUBuYLtrPqMORwt1CjMQ"  # Replace with your Roboflow API key
-    project_id = "egg-candling-v1.0"  # Replace with your Roboflow project ID
-    model_version = 1  # Replace with your model version
-
-    # Load the Roboflow model
-    model = load_roboflow_model(api_key, project_id, model_version)
-    if model is None:
+    if API_KEY in ("", API_KEY_PLACEHOLDER):
+        print("No Roboflow API key configured: set api_key in the [roboflow] section of intelliegg.ini")
         return
 
-    # URLs for fetching and saving data
-    fetch_url = "http://intelliegg.site/webpages/fetch_data.php"
-    insert_url = "http://intelliegg.site/webpages/insert_data.php"
+    cache = InferenceCache(CACHE_PATH, CACHE_MAX_BYTES)
+    client = InferenceClient(cache=cache)
 
     # Fetch unprocessed images
-    unprocessed_images = get_unprocessed_images(fetch_url)
+    unprocessed_images = get_unprocessed_images(FETCH_URL)
     print(f"Found {len(unprocessed_images)} unprocessed images")
 
-    # Process each image
-    for image in unprocessed_images:
-        image_id = image['id']
-        image_data = image['image_data']
-        detection_date = image['detection_Date']
-
-        # Process the image and annotate it
-        annotated_image_base64, detection_date = process_image(model, image_id, image_data, detection_date)
-        if annotated_image_base64:
-            # Save the results to the database
-            save_results_to_php(insert_url, annotated_image_base64, detection_date)
-            print(f"Processed and saved image {image_id}")
-        else:
-            print(f"No eggs detected in image {image_id}")
+    # Process the images on a bounded pool of worker threads
+    with ThreadPoolExecutor(max_workers=INFERENCE_WORKERS) as executor:
+        for future in [executor.submit(process_and_save, client, image) for image in unprocessed_images]:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error processing image: {str(e)}")
+
+    print(f"Inference cache: {cache.hits} hits, {cache.misses} misses")
+    cache.close()
 
 if __name__ == "__main__":
     main()
@@ -1,151 +1,1190 @@
 import os
 import io
-import mysql.connector
+import time
+import queue
+import threading
+import json
+import signal
+import argparse
+import re
+import zlib
+import multiprocessing
+import hashlib
+import shutil
+import importlib.util
+import traceback
 from mysql.connector import Error
-from ultralytics import YOLO
 from PIL import Image
 import numpy as np
 from datetime import datetime
+from tray_layout import get_tray_layout
+from config import get_setting
+from database import DatabasePool
+from image_store import IMAGE_STORE_ENABLED, ImageStore, ensure_image_store_columns
+import metrics
+
+# Batch inference settings: how many decoded images go through the model in one call,
+# and how long (seconds) a partially filled batch may wait before it is flushed anyway
+BATCH_SIZE = get_setting("processing", "batch_size", 8, int)
+BATCH_MAX_WAIT = get_setting("processing", "batch_max_wait", 2.0, float)
+
+# Number of image blobs pulled from the database per page when streaming unprocessed images
+FETCH_PAGE_SIZE = get_setting("processing", "fetch_page_size", 16, int)
+
+# Pipeline settings: decode worker count, capacity of each bounded queue between stages,
+# and how often (seconds) the queue depths are reported
+DECODE_WORKERS = get_setting("processing", "decode_workers", 2, int)
+PIPELINE_QUEUE_SIZE = get_setting("processing", "pipeline_queue_size", 16, int)
+QUEUE_REPORT_INTERVAL = get_setting("processing", "queue_report_interval", 10, float)
+
+# Write-behind settings: buffered results are written in one multi-row upsert once this many
+# rows are waiting or the oldest waiting row is this many seconds old
+WRITE_BATCH_ROWS = get_setting("processing", "write_batch_rows", 500, int)
+WRITE_MAX_DELAY = get_setting("processing", "write_max_delay", 5.0, float)
+
+# Incubator recorded with the results of images whose images.incubatorNo is NULL
+INCUBATOR = get_setting("processing", "incubator", "incubator1")
+
+# Worker pool: WORKERS model processes share the pending images, sharded by "id" (id modulo WORKERS)
+# or "incubator" (every image of an incubator goes to the same worker). Each worker is pinned to
+# WORKER_THREADS cores and intra-op threads; 0 splits the available cores evenly
+WORKERS = get_setting("processing", "workers", 1, int)
+SHARD_BY = get_setting("processing", "shard_by", "id")
+WORKER_THREADS = get_setting("processing", "worker_threads", 0, int)
+
+# YOLO checkpoint used for detection
+MODEL_PATH = get_setting(
+    "processing", "model_path",
+    "/home/pi/aws-computer-vision-industrial-egg-fertility-sorting-system/egg_detection_yolov8n_final.pt"
+)
+
+# Inference backend: "auto" picks the fastest runtime that is installed and exports to it, or one of
+# pytorch/onnx/openvino/ncnn. Exported models are cached in MODEL_CACHE_DIR keyed on the checkpoint hash
+MODEL_BACKEND = get_setting("model", "model_backend", "auto")
+MODEL_INT8 = get_setting("model", "model_int8", False, bool)
+MODEL_INT8_DATA = get_setting("model", "model_int8_data", "")
+MODEL_IMGSZ = get_setting("model", "model_imgsz", 640, int)
+MODEL_CACHE_DIR = get_setting("model", "model_cache_dir", "model_cache")
+MODEL_WARMUP = get_setting("model", "model_warmup", True, bool)
+
+# Reduced-resolution preprocessing: stored JPEGs are decoded at the smallest libjpeg scale (1/2, 1/4
+# or 1/8) that still covers MODEL_IMGSZ and letterboxed into one of LETTERBOX_BUFFERS preallocated
+# model-sized buffers (0 sizes the pool from the batch size and decode workers). Set
+# letterbox_decode = false to hand full-size images to the model instead
+LETTERBOX_DECODE = get_setting("model", "letterbox_decode", True, bool)
+LETTERBOX_BUFFERS = get_setting("model", "letterbox_buffers", 0, int)
+LETTERBOX_FILL = 114  # Padding gray used by ultralytics' own letterbox
+
+# Export formats fastest first on the Pi's ARM cores, with the module each runtime needs
+EXPORT_BACKENDS = [("ncnn", "ncnn"), ("openvino", "openvino"), ("onnx", "onnxruntime")]
+
+# Backends whose exported graphs take one image per call; batches are split for them
+SINGLE_IMAGE_BACKENDS = {"ncnn"}
+
+# Daemon mode: the high-water mark (last processed images.id) is kept in STATE_PATH, and
+# polling backs off from POLL_MIN_INTERVAL to POLL_MAX_INTERVAL seconds while nothing arrives.
+# NOTIFY_TABLE optionally names a small table with an image_id column (e.g. filled by an
+# AFTER INSERT trigger on images) that is probed instead of images itself
+STATE_PATH = get_setting("daemon", "state_path", "processor_state.json")
+POLL_MIN_INTERVAL = get_setting("daemon", "poll_min_interval", 2.0, float)
+POLL_MAX_INTERVAL = get_setting("daemon", "poll_max_interval", 60.0, float)
+NOTIFY_TABLE = get_setting("daemon", "notify_table", "")
+
+# Per-stage timings are written as JSON to METRICS_JSON_PATH after every pipeline run
+METRICS_JSON_PATH = get_setting("metrics", "metrics_json_path", "processor_metrics.json")
+DECODE_SECONDS = metrics.histogram("intelliegg_decode_seconds", "Time to decode one stored JPEG")
+INFERENCE_SECONDS = metrics.histogram("intelliegg_inference_seconds", "Time of one model call")
+IMAGES_INFERRED = metrics.counter("intelliegg_images_inferred_total", "Images passed through the model")
+GRID_MAPPING_SECONDS = metrics.histogram("intelliegg_grid_mapping_seconds", "Time to map one image's detections onto the tray grid")
+DB_SAVE_SECONDS = metrics.histogram("intelliegg_db_save_seconds", "Time of one result upsert")
+ROWS_SAVED = metrics.counter("intelliegg_result_rows_saved_total", "Egg result rows written to the database")
+
+# Marker passed down the pipeline queues to tell a stage that its input is finished
+STOP = object()
+
+# Result passed to the writer for an image that could not be decoded; it is recorded as processed
+# (with no egg count) so it is not selected again on every run
+UNDECODABLE = object()
+
+# Images are unprocessed until they have a row in processed_images, which the writer adds for every
+# image it finishes, including those without eggs and those that could not be decoded. The
+# fertility_status check covers images processed before processed_images existed
+UNPROCESSED_CONDITION = """
+    NOT EXISTS (SELECT 1 FROM fertility_status f WHERE f.image_id = i.id)
+    AND NOT EXISTS (SELECT 1 FROM processed_images p WHERE p.image_id = i.id)
+"""
+
+# Function to hash the checkpoint file, so exports are rebuilt whenever the weights change
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Function to check whether the runtime for an export backend is installed
+def backend_available(backend):
+    modules = dict(EXPORT_BACKENDS)
+    return backend in modules and importlib.util.find_spec(modules[backend]) is not None
+
+# Function to quantise an exported ONNX model's weights to INT8 with onnxruntime
+def quantize_onnx(onnx_path):
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    int8_path = onnx_path.replace(".onnx", "_int8.onnx")
+    quantize_dynamic(onnx_path, int8_path, weight_type=QuantType.QUInt8)
+    os.remove(onnx_path)
+    return int8_path
+
+# Function to get the cached export of a checkpoint for the given backend, exporting it on first use
+# Cache layout: <cache_dir>/<checkpoint sha256>/<backend>[-int8]-<imgsz>/<exported file or directory>
+def export_model(model_path, backend, imgsz=MODEL_IMGSZ, int8=MODEL_INT8, cache_dir=MODEL_CACHE_DIR):
+    variant = f"{backend}{'-int8' if int8 else ''}-{imgsz}"
+    target_dir = os.path.join(cache_dir, file_sha256(model_path)[:16], variant)
+    if os.path.isdir(target_dir) and os.listdir(target_dir):
+        return os.path.join(target_dir, os.listdir(target_dir)[0])
+
+    print(f"Exporting {model_path} to {variant}, this only happens once per checkpoint")
+    export_args = {"format": backend, "imgsz": imgsz}
+    if backend in ("onnx", "openvino"):
+        export_args["dynamic"] = True  # Lets batches of any size through the exported graph
+    if int8 and backend == "openvino":
+        export_args["int8"] = True
+        if MODEL_INT8_DATA:
+            export_args["data"] = MODEL_INT8_DATA  # Calibration dataset yaml
+    elif int8 and backend == "ncnn":
+        print("INT8 export is not supported for ncnn, exporting with float weights")
+
+    from ultralytics import YOLO
+    exported_path = YOLO(model_path).export(**export_args)
+    if int8 and backend == "onnx":
+        exported_path = quantize_onnx(exported_path)
+
+    os.makedirs(target_dir, exist_ok=True)
+    cached_path = os.path.join(target_dir, os.path.basename(exported_path.rstrip(os.sep)))
+    shutil.move(exported_path, cached_path)
+    return cached_path
+
+# Function to run one dummy inference so graph initialisation is not paid by the first real image
+def warm_up_model(model, imgsz=MODEL_IMGSZ):
+    started = time.monotonic()
+    model(np.zeros((imgsz, imgsz, 3), dtype=np.uint8), verbose=False)
+    print(f"Model warm-up took {time.monotonic() - started:.2f}s")
+
+# Function to rebuild an exported model's runtime session with at most `threads` intra-op threads
+# ONNX Runtime and OpenVINO size their thread pools from the core count and ignore OMP_NUM_THREADS,
+# so without this every pool worker would start one thread per core. The session is created by
+# ultralytics on the first prediction, so this runs after one
+def limit_runtime_threads(model, backend, exported_path, threads):
+    runtime = model.predictor.model  # ultralytics AutoBackend
+    if backend == "onnx":
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        runtime.session = onnxruntime.InferenceSession(exported_path, options,
+                                                       providers=runtime.session.get_providers())
+    elif backend == "openvino":
+        import openvino as ov
+        core = ov.Core()
+        xml_path = next(os.path.join(exported_path, name) for name in os.listdir(exported_path) if name.endswith(".xml"))
+        ov_model = core.read_model(xml_path)
+        if ov_model.get_parameters()[0].get_layout().empty:
+            ov_model.get_parameters()[0].set_layout(ov.Layout("NCHW"))
+        runtime.ov_compiled_model = core.compile_model(
+            ov_model, device_name="CPU", config={"PERFORMANCE_HINT": "LATENCY", "INFERENCE_NUM_THREADS": threads}
+        )
+    elif backend == "ncnn":
+        runtime.net.opt.num_threads = threads  # Read by every extractor the backend creates
 
 # Function to load the YOLO model
-def load_model(model_path):
-    try:
-        model = YOLO(model_path)
-        print(f"Model loaded successfully from {model_path}")
-        return model
-    except Exception as e:
-        print(f"Error loading model: {str(e)}")
-        return None
+# With backend "auto" the installed runtimes are tried fastest first, falling back to the .pt checkpoint.
+# threads limits the runtime's intra-op threads (pool workers pass their share of the cores)
+def load_model(model_path, backend=MODEL_BACKEND, int8=MODEL_INT8, imgsz=MODEL_IMGSZ, warmup=MODEL_WARMUP,
+               threads=None):
+    # Imported here so the selection and result-writing helpers can be used without the model stack
+    from ultralytics import YOLO
+    if backend == "auto":
+        candidates = [name for name, _ in EXPORT_BACKENDS if backend_available(name)] + ["pytorch"]
+    else:
+        candidates = [backend]
+
+    for candidate in candidates:
+        try:
+            if candidate == "pytorch":
+                model = YOLO(model_path)
+            else:
+                exported_path = export_model(model_path, candidate, imgsz, int8)
+                model = YOLO(exported_path, task="detect")
+            model.overrides["imgsz"] = imgsz
+            model.max_batch = 1 if candidate in SINGLE_IMAGE_BACKENDS else None
+            if threads and candidate != "pytorch":
+                model(np.zeros((imgsz, imgsz, 3), dtype=np.uint8), verbose=False)  # Creates the session
+                limit_runtime_threads(model, candidate, exported_path, threads)
+                print(f"Limited the {candidate} runtime to {threads} threads")
+            if warmup:
+                warm_up_model(model, imgsz)
+            print(f"Model loaded successfully from {model_path} using the {candidate} backend")
+            return model
+        except Exception as e:
+            print(f"Error loading model with the {candidate} backend: {str(e)}")
+    return None
 
 # Function to run prediction on the given image using the YOLO model
 def predict_image(model, image):
     try:
-        results = model(image)
+        with INFERENCE_SECONDS.time():
+            results = model(image)
+        IMAGES_INFERRED.inc()
         return results
     except Exception as e:
         print(f"Error predicting image: {str(e)}")
         return None
 
-# Function to connect to the MySQL database
+# Function to run prediction on a list of images in a single model call
+# Returns one result per input image, in the same order, or None on failure
+def predict_images(model, images):
+    try:
+        images = list(images)
+        max_batch = getattr(model, "max_batch", None) or len(images)
+        results = []
+        for start in range(0, len(images), max_batch):
+            with INFERENCE_SECONDS.time():
+                results.extend(model(images[start:start + max_batch]))
+        IMAGES_INFERRED.inc(len(images))
+        if len(results) != len(images):
+            print(f"Error predicting images: got {len(results)} results for {len(images)} images")
+            return None
+        return results
+    except Exception as e:
+        print(f"Error predicting images: {str(e)}")
+        return None
+
+# Function to connect to the database
+# Returns a shared DatabasePool (see database.py) that threads check connections out of,
+# or None if the server cannot be reached even after retrying
 def connect_to_database():
+    db = DatabasePool()
+    if not db.is_healthy():
+        return None
+    print("Connected to database successfully")
+    return db
+
+# Function to select (id, incubator) of images that have not been processed yet
+def select_unprocessed_image_ids(connection, default_incubator=INCUBATOR):
+    cursor = connection.cursor()
     try:
-        connection = mysql.connector.connect(
-            host="192.168.0.101",  # Replace with your laptop's IP address
-            user="root",
-            password="",
-            database="intelliegg"
+        cursor.execute(f"""
+            SELECT i.id, COALESCE(i.incubatorNo, %s) FROM images i
+            WHERE {UNPROCESSED_CONDITION}
+            ORDER BY i.id
+        """, (default_incubator,))
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+# Function to select one page of (id, image_data, detection_Date, incubator) rows through an unbuffered cursor
+# With the image store enabled each row also carries image_hash, for rows whose image_data is NULL
+def select_image_page(connection, page_ids, with_hash=IMAGE_STORE_ENABLED, default_incubator=INCUBATOR):
+    placeholders = ", ".join(["%s"] * len(page_ids))
+    columns = "id, image_data, detection_Date, COALESCE(incubatorNo, %s)"
+    if with_hash:
+        columns += ", image_hash"
+    cursor = connection.cursor(buffered=False)
+    try:
+        cursor.execute(
+            f"SELECT {columns} FROM images WHERE id IN ({placeholders}) ORDER BY id",
+            [default_incubator, *page_ids]
         )
-        print("Connected to database successfully")
-        if connection.is_connected():
-            print("Database connection is valid")
-        return connection
-    except Error as e:
-        print(f"Error connecting to database: {str(e)}")
-        return None
+        return cursor.fetchall()
+    finally:
+        cursor.close()
 
-# Function to fetch unprocessed images from the database
-def get_unprocessed_images(connection):
+# Function to select (id, incubator) of unprocessed images above the high-water mark
+def select_image_ids_above(connection, high_water_mark, default_incubator=INCUBATOR):
     cursor = connection.cursor()
     try:
-        cursor.execute("SELECT id, image_data, detection_Date FROM images")
-        all_images = cursor.fetchall()
-        print(f"Fetched {len(all_images)} images from the 'images' table")
+        cursor.execute(f"""
+            SELECT i.id, COALESCE(i.incubatorNo, %s) FROM images i
+            WHERE i.id > %s AND {UNPROCESSED_CONDITION}
+            ORDER BY i.id
+        """, (default_incubator, high_water_mark))
+        return cursor.fetchall()
+    finally:
+        cursor.close()
 
-        cursor.execute("SELECT DISTINCT image_id FROM fertility_status")
-        processed_image_ids = set(row for row in cursor.fetchall())
+# Function to select the newest image id, from the notification table when one is configured
+def select_newest_image_id(connection, notify_table=NOTIFY_TABLE):
+    cursor = connection.cursor()
+    try:
+        if notify_table:
+            cursor.execute(f"SELECT MAX(image_id) FROM {notify_table}")
+        else:
+            cursor.execute("SELECT MAX(id) FROM images")
+        row = cursor.fetchone()
+        return row[0] if row else None
+    finally:
+        cursor.close()
+
+# Function to get the number an incubator is sharded by: the trailing number of names like
+# "incubator3", so consecutive incubators land on different workers, otherwise a stable crc32
+def incubator_shard_key(incubator):
+    match = re.search(r"(\d+)$", str(incubator))
+    return int(match.group(1)) if match else zlib.crc32(str(incubator).encode())
 
-        unprocessed_images = [img for img in all_images if img not in processed_image_ids]
-        return unprocessed_images
+# Function to keep the ids of the (id, incubator) rows that belong to a worker's shard
+# shard is (index, workers, shard_by), or None for all rows
+def shard_image_ids(rows, shard=None):
+    if shard is None:
+        return [image_id for image_id, _ in rows]
+    index, workers, shard_by = shard
+    if shard_by == "incubator":
+        return [image_id for image_id, incubator in rows if incubator_shard_key(incubator) % workers == index]
+    return [image_id for image_id, _ in rows if image_id % workers == index]
+
+# Function to fetch the ids of images that have not been processed yet
+def get_unprocessed_image_ids(db, shard=None):
+    try:
+        return shard_image_ids(db.run(select_unprocessed_image_ids), shard)
     except Error as e:
-        print(f"Error fetching unprocessed images from database: {str(e)}")
+        print(f"Error fetching unprocessed image ids from database: {str(e)}")
         return []
+
+# Function to stream (id, image_data, detection_Date, incubator) rows for the given ids, one page at a time
+# Each page is read in full and its connection returned to the pool before the rows are handed out,
+# so at most page_size blobs are held in memory. Rows kept in the image store come back with their
+# file mapped in place of image_data
+def fetch_images(db, image_ids, page_size=FETCH_PAGE_SIZE):
+    store = ImageStore() if IMAGE_STORE_ENABLED else None
+    for start in range(0, len(image_ids), page_size):
+        page_ids = image_ids[start:start + page_size]
+        try:
+            page = db.run(select_image_page, page_ids)
+        except Error as e:
+            print(f"Error fetching images {page_ids[0]}..{page_ids[-1]} from database: {str(e)}")
+            continue
+
+        if store is None:
+            yield from page
+            continue
+        for image_id, image_data, detection_date, incubator, image_hash in page:
+            if image_data is None and image_hash:
+                try:
+                    image_data = store.open(image_hash)
+                except (OSError, ValueError) as e:
+                    print(f"Error reading stored image {image_id} ({image_hash}): {str(e)}")
+                    continue
+            yield image_id, image_data, detection_date, incubator
+
+# Function to fetch unprocessed images from the database
+# Returns the number of pending images and a generator streaming their rows page by page
+def get_unprocessed_images(db, page_size=FETCH_PAGE_SIZE):
+    image_ids = get_unprocessed_image_ids(db)
+    return len(image_ids), fetch_images(db, image_ids, page_size)
+
+# Fixed set of model-sized BGR buffers shared by the decode threads
+# acquire() blocks while every buffer is in flight, which also bounds the decoded images held in memory
+class LetterboxPool:
+    def __init__(self, imgsz=MODEL_IMGSZ, size=None):
+        if not size:
+            size = BATCH_SIZE * 2 + DECODE_WORKERS
+        self.imgsz = imgsz
+        self.free = queue.Queue()
+        for _ in range(max(size, BATCH_SIZE + 1)):  # A whole batch must fit, or the decoders would block inference
+            self.free.put(np.empty((imgsz, imgsz, 3), dtype=np.uint8))
+
+    def acquire(self):
+        return self.free.get()
+
+    def release(self, buffer):
+        self.free.put(buffer)
+
+# A decoded image letterboxed into a pool buffer
+# size is the original (width, height); letterbox is (scale, pad_x, pad_y), mapping model
+# coordinates back to the original image as (x - pad_x) / scale
+class LetterboxedImage:
+    def __init__(self, array, size, letterbox, pool):
+        self.array = array
+        self.size = size
+        self.letterbox = letterbox
+        self.pool = pool
+
+    # Function to hand the buffer back to the pool once the model is done with it
+    def release(self):
+        if self.pool is not None:
+            self.pool.release(self.array)
+            self.pool = None
+
+letterbox_pool = None
+letterbox_pool_lock = threading.Lock()
+
+# Function to get the shared letterbox pool, or None when letterbox_decode is off
+def get_letterbox_pool():
+    global letterbox_pool
+    if not LETTERBOX_DECODE:
+        return None
+    with letterbox_pool_lock:
+        if letterbox_pool is None:
+            letterbox_pool = LetterboxPool(MODEL_IMGSZ, LETTERBOX_BUFFERS)
+        return letterbox_pool
+
+# Function to decode an image at reduced resolution straight into a letterbox buffer
+# draft() makes libjpeg scale in the DCT domain, so the full-size image is never decoded; only the
+# remaining factor of at most 2 is done by resize(). Returns the original size and (scale, pad_x, pad_y)
+def letterbox_decode(image_data, buffer):
+    imgsz = buffer.shape[0]
+    image = Image.open(image_file(image_data))
+    width, height = image.size
+    scale = min(imgsz / width, imgsz / height)
+    new_width, new_height = max(1, round(width * scale)), max(1, round(height * scale))
+    image.draft("RGB", (new_width, new_height))
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if image.size != (new_width, new_height):
+        image = image.resize((new_width, new_height), Image.BILINEAR)
+
+    pad_x = (imgsz - new_width) // 2
+    pad_y = (imgsz - new_height) // 2
+    buffer[:pad_y] = LETTERBOX_FILL
+    buffer[pad_y + new_height:] = LETTERBOX_FILL
+    buffer[pad_y:pad_y + new_height, :pad_x] = LETTERBOX_FILL
+    buffer[pad_y:pad_y + new_height, pad_x + new_width:] = LETTERBOX_FILL
+    buffer[pad_y:pad_y + new_height, pad_x:pad_x + new_width] = np.asarray(image)[:, :, ::-1]  # RGB -> BGR
+    return (width, height), (scale, pad_x, pad_y)
+
+# Function to wrap image bytes as a file for PIL; a mapped store file already is one
+def image_file(image_data):
+    return image_data if hasattr(image_data, "read") else io.BytesIO(image_data)
+
+# Function to decode the stored image bytes for the model
+# Returns a LetterboxedImage (release() it after inference) or, with letterbox_decode off, a PIL image
+def decode_image(image_id, image_data):
+    pool = get_letterbox_pool()
+    buffer = pool.acquire() if pool else None
+    try:
+        with DECODE_SECONDS.time():
+            if buffer is not None:
+                size, letterbox = letterbox_decode(image_data, buffer)
+                return LetterboxedImage(buffer, size, letterbox, pool)
+            image = Image.open(image_file(image_data))
+            image.load()  # Decode now rather than lazily on first pixel access
+        return image
+    except Exception as e:
+        if buffer is not None:
+            pool.release(buffer)
+        print(f"Error opening image {image_id}: {str(e)}")
+        return None
     finally:
-        cursor.close()
+        if hasattr(image_data, "close"):
+            image_data.close()  # Unmap a store file as soon as it is decoded
+
+# Function to get what is passed to the model for a decoded image
+def model_input(image):
+    return image.array if isinstance(image, LetterboxedImage) else image
+
+# Function to return a decoded image's buffer to the pool, if it has one
+def release_image(image):
+    if isinstance(image, LetterboxedImage):
+        image.release()
+
+# Function to map the detections of one image onto the tray grid
+# All boxes are assigned at once from the raw xyxy/conf/cls tensors; see tray_layout.TrayLayout
+# letterbox is the (scale, pad_x, pad_y) of a LetterboxedImage, used to move the boxes back to
+# original-image coordinates first
+def map_results_to_grid(image_id, results, image_size, detection_date, layout=None, letterbox=None):
+    with GRID_MAPPING_SECONDS.time():
+        return _map_results_to_grid(image_id, results, image_size, detection_date, layout, letterbox)
+
+def _map_results_to_grid(image_id, results, image_size, detection_date, layout, letterbox):
+    if layout is None:
+        layout = get_tray_layout()
+
+    boxes = [result.boxes for result in results if result.boxes is not None and len(result.boxes)]
+    if not boxes:
+        return []
+
+    xyxy = np.concatenate([b.xyxy.cpu().numpy() for b in boxes])
+    conf = np.concatenate([b.conf.cpu().numpy() for b in boxes])
+    cls = np.concatenate([b.cls.cpu().numpy() for b in boxes])
+    if letterbox is not None:
+        scale, pad_x, pad_y = letterbox
+        xyxy = (xyxy - np.array([pad_x, pad_y, pad_x, pad_y], dtype=xyxy.dtype)) / scale
+
+    rows, cols, confidences, class_ids = layout.assign(xyxy, conf, cls, image_size)
+
+    egg_data = []
+    for row, col, confidence, class_id in zip(rows.tolist(), cols.tolist(), confidences.tolist(), class_ids.tolist()):
+        status = "fertile" if class_id == 0 else "infertile"
+        egg_data.append((image_id, row + 1, col + 1, status, confidence, detection_date))
+
+    return egg_data
 
 # Function to process the image, detect eggs, and determine their positions and status
-def process_image(model, image_id, image_data, detection_date):
-    image = Image.open(io.BytesIO(image_data))
-    results = predict_image(model, image)
-    
+# The cells come from the tray layout of the image's incubator
+def process_image(model, image_id, image_data, detection_date, incubator=None):
+    image = decode_image(image_id, image_data)
+    if image is None:
+        return []
+
+    try:
+        results = predict_image(model, model_input(image))
+    finally:
+        release_image(image)
+
     if results is None:
         print(f"No eggs detected in image {image_id}.")
         return []  # Return an empty list if no eggs are detected.
 
-    egg_data = []
-    img_width, img_height = image.size
-    cell_width = img_width / 8  # 8 columns
-    cell_height = img_height / 7  # 7 rows
+    return map_results_to_grid(image_id, results, image.size, detection_date, get_tray_layout(incubator),
+                               getattr(image, "letterbox", None))
 
-    egg_grid = [[None for _ in range(8)] for _ in range(7)]
+# Function to run one model call over already decoded (image_id, image, detection_date, incubator) items
+# Returns a list of (image_id, incubator, egg_data) in the same order; egg_data is None if the model call failed
+# Each image's detections are mapped onto the tray layout of its own incubator
+def infer_decoded_batch(model, decoded):
+    try:
+        results = predict_images(model, [model_input(image) for _, image, _, _ in decoded])
+    finally:
+        for _, image, _, _ in decoded:
+            release_image(image)
+    if results is None:
+        print(f"Batch prediction failed for images {[image_id for image_id, _, _, _ in decoded]}")
+        return [(image_id, incubator, None) for image_id, _, _, incubator in decoded]
 
-    for result in results:
-        for box in result.boxes:
-            xyxy = box.xyxy.tolist()
-            if len(xyxy) != 4:
-                print(f"Skipping box due to incorrect format: {xyxy}")
-                continue
+    processed = []
+    for (image_id, image, detection_date, incubator), result in zip(decoded, results):
+        egg_data = map_results_to_grid(image_id, [result], image.size, detection_date, get_tray_layout(incubator),
+                                       getattr(image, "letterbox", None))
+        processed.append((image_id, incubator, egg_data))
+    return processed
 
-            x1, y1, x2, y2 = xyxy
-            confidence = box.conf.item()
-            class_id = int(box.cls)
-            status = "fertile" if class_id == 0 else "infertile"
+# Function to add the unique key that the upsert relies on, if fertility_status does not have it yet
+def add_result_unique_key(connection, dialect):
+    cursor = connection.cursor()
+    try:
+        if dialect == "sqlite":
+            cursor.execute("""
+                CREATE UNIQUE INDEX IF NOT EXISTS uniq_image_cell
+                ON fertility_status (image_id, `row_number`, column_number)
+            """)
+            connection.commit()
+            return
 
-            center_x = (x1 + x2) / 2
-            center_y = (y1 + y2) / 2
+        cursor.execute("""
+            SELECT INDEX_NAME FROM information_schema.STATISTICS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'fertility_status' AND NON_UNIQUE = 0
+            GROUP BY INDEX_NAME
+            HAVING GROUP_CONCAT(COLUMN_NAME ORDER BY SEQ_IN_INDEX) = 'image_id,row_number,column_number'
+        """)
+        if cursor.fetchall():
+            return
+        cursor.execute("""
+            ALTER TABLE fertility_status
+            ADD UNIQUE KEY uniq_image_cell (image_id, `row_number`, column_number)
+        """)
+        print("Added unique key (image_id, row_number, column_number) to fertility_status")
+    finally:
+        cursor.close()
 
-            col = int(center_x // cell_width)
-            row = int(center_y // cell_height)
+# Function to add the nullable images.incubatorNo column that capture fills in, if it is missing
+def add_image_incubator_column(connection, dialect):
+    cursor = connection.cursor()
+    try:
+        if dialect == "sqlite":
+            cursor.execute("PRAGMA table_info(images)")
+            if "incubatorNo" not in {row[1] for row in cursor.fetchall()}:
+                cursor.execute("ALTER TABLE images ADD COLUMN incubatorNo TEXT")
+                connection.commit()
+            return
 
-            egg_grid[row][col] = (status, confidence)
+        cursor.execute("""
+            SELECT 1 FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'images' AND COLUMN_NAME = 'incubatorNo'
+        """)
+        if cursor.fetchall():
+            return
+        cursor.execute("ALTER TABLE images ADD COLUMN incubatorNo VARCHAR(64) NULL, ADD INDEX idx_incubator (incubatorNo)")
+        print("Added incubatorNo column to images")
+    finally:
+        cursor.close()
 
-    for row in range(7):
-        for col in range(8):
-            if egg_grid[row][col] is not None:
-                status, confidence = egg_grid[row][col]
-                egg_data.append((image_id, row + 1, col + 1, status, confidence, detection_date))
+# Function to create the processed_images table that marks every image the processor has finished
+def add_processed_images_table(connection, dialect):
+    cursor = connection.cursor()
+    try:
+        if dialect == "sqlite":
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS processed_images (
+                    image_id INTEGER PRIMARY KEY, egg_count INTEGER, processed_at TEXT NOT NULL
+                )
+            """)
+        else:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS processed_images (
+                    image_id INT NOT NULL PRIMARY KEY, egg_count INT NULL, processed_at DATETIME NOT NULL
+                )
+            """)
+        connection.commit()
+    finally:
+        cursor.close()
 
-    return egg_data
+# Function to make sure the processed_images table exists
+def ensure_processed_images_table(db):
+    try:
+        db.run(add_processed_images_table, db.dialect)
+        return True
+    except Error as e:
+        print(f"Error creating the processed_images table: {str(e)}")
+        return False
+
+# Function to make sure images has the incubatorNo column that the image queries read
+def ensure_image_incubator_column(db):
+    try:
+        db.run(add_image_incubator_column, db.dialect)
+        return True
+    except Error as e:
+        print(f"Error adding incubatorNo column to images: {str(e)}")
+        return False
+
+# Function to make sure fertility_status has the unique key that the upsert relies on
+def ensure_result_unique_key(db):
+    try:
+        db.run(add_result_unique_key, db.dialect)
+        return True
+    except Error as e:
+        print(f"Error adding unique key to fertility_status, remove duplicate rows first: {str(e)}")
+        return False
 
-# Function to save the detected egg data to the database
-def save_results_to_database(connection, egg_data):
+# Function to write (image_id, row, column, status, confidence, detection_date, incubator) rows from any
+# number of images with a single multi-row upsert
+# Returns the affected row count; the caller commits
+def upsert_results(connection, rows, dialect):
+    values = ", ".join(["(%s, %s, %s, %s, %s, %s, %s)"] * len(rows))
+    params = [value for row in rows for value in row]
+    if dialect == "sqlite":
+        on_duplicate = """
+            ON CONFLICT (image_id, `row_number`, column_number) DO UPDATE SET
+                status = excluded.status,
+                confidence = excluded.confidence,
+                detection_date = excluded.detection_date,
+                incubatorNo = excluded.incubatorNo
+        """
+    else:
+        on_duplicate = """
+            ON DUPLICATE KEY UPDATE
+                status = VALUES(status),
+                confidence = VALUES(confidence),
+                detection_date = VALUES(detection_date),
+                incubatorNo = VALUES(incubatorNo)
+        """
     cursor = connection.cursor()
     try:
-        cursor.executemany("""
+        cursor.execute(f"""
             INSERT INTO fertility_status 
-            (image_id, row_number, column_number, status, confidence, detection_date, incubatorNo) 
-            VALUES (%s, %s, %s, %s, %s, %s, 'incubator1')
-        """, egg_data)
-        connection.commit()
-        print(f"Saved {len(egg_data)} egg results to the database")
-        print(f"Affected rows: {cursor.rowcount}")
+            (image_id, `row_number`, column_number, status, confidence, detection_date, incubatorNo) 
+            VALUES {values}
+            {on_duplicate}
+        """, params)
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+# Function to record (image_id, egg_count, processed_at) rows in processed_images; the caller commits
+# egg_count is None for an image that could not be decoded
+def mark_images_processed(connection, processed, dialect):
+    values = ", ".join(["(%s, %s, %s)"] * len(processed))
+    params = [value for row in processed for value in row]
+    if dialect == "sqlite":
+        on_duplicate = "ON CONFLICT (image_id) DO UPDATE SET egg_count = excluded.egg_count, processed_at = excluded.processed_at"
+    else:
+        on_duplicate = "ON DUPLICATE KEY UPDATE egg_count = VALUES(egg_count), processed_at = VALUES(processed_at)"
+    cursor = connection.cursor()
+    try:
+        cursor.execute(f"""
+            INSERT INTO processed_images (image_id, egg_count, processed_at)
+            VALUES {values}
+            {on_duplicate}
+        """, params)
+    finally:
+        cursor.close()
+
+# Function to upsert result rows and mark the processed images in one transaction
+def write_results(connection, rows, processed, dialect):
+    affected_rows = upsert_results(connection, rows, dialect) if rows else 0
+    if processed:
+        mark_images_processed(connection, processed, dialect)
+    connection.commit()
+    return affected_rows
+
+# Function to save result rows (egg_data rows followed by their incubator) to the database in one transaction
+# Replaying an image overwrites its cells instead of duplicating them, which also makes
+# the statement safe to retry after a dropped connection. processed lists the
+# (image_id, egg_count, processed_at) markers written along with the rows
+def save_result_rows(db, rows, processed=()):
+    if not rows and not processed:
+        return True
+
+    try:
+        with DB_SAVE_SECONDS.time():
+            affected_rows = db.run(write_results, rows, processed, db.dialect)
+        ROWS_SAVED.inc(len(rows))
+        print(f"Saved {len(rows)} egg results to the database")
+        print(f"Affected rows: {affected_rows}")
+        return True
     except Error as e:
         print(f"Error saving results to the database: {str(e)}")
+        return False
+
+# Function to save the detected egg data of one incubator to the database
+def save_results_to_database(db, egg_data, incubator=INCUBATOR, processed=()):
+    return save_result_rows(db, [(*row, incubator) for row in egg_data], processed)
+
+# Write-behind buffer that collects results from many images and saves them together
+# Every image is also marked in processed_images, so images without eggs are not selected again.
+# written collects the ids of the images whose results were saved
+class ResultWriter:
+    def __init__(self, db, max_rows=WRITE_BATCH_ROWS, max_delay=WRITE_MAX_DELAY):
+        self.db = db
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.rows = []
+        self.image_ids = []
+        self.processed = []
+        self.oldest = None
+        self.written = set()
+
+    # Function to buffer the results of one image, flushing if the size threshold is reached
+    # egg_count is None for an image that could not be decoded
+    def add(self, image_id, incubator, egg_data, egg_count=0):
+        if not self.image_ids:
+            self.oldest = time.monotonic()
+        self.rows.extend((*row, incubator) for row in egg_data)
+        self.image_ids.append(image_id)
+        self.processed.append((image_id, egg_count, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        if len(self.rows) >= self.max_rows or len(self.image_ids) >= self.max_rows:
+            self.flush()
+
+    # Function to get the seconds left until the buffer is due, or None when it is empty
+    def time_until_due(self):
+        if not self.image_ids:
+            return None
+        return max(0.0, self.oldest + self.max_delay - time.monotonic())
+
+    # Function to write out the buffered rows if the time threshold has passed
+    def flush_if_due(self):
+        if self.image_ids and self.time_until_due() == 0.0:
+            self.flush()
+
+    # Function to write out all buffered rows in one transaction
+    def flush(self):
+        if not self.image_ids:
+            return
+        if save_result_rows(self.db, self.rows, self.processed):
+            self.written.update(self.image_ids)
+            print(f"Processed and saved images {self.image_ids}")
+        else:
+            print(f"Failed to save results of images {self.image_ids}")
+        self.rows = []
+        self.image_ids = []
+        self.processed = []
+        self.oldest = None
+
+# Function to take up to batch_size items from a queue, waiting at most max_wait after the first one
+# Returns the batch and whether the STOP marker was reached
+def collect_batch(input_queue, batch_size=BATCH_SIZE, max_wait=BATCH_MAX_WAIT):
+    item = input_queue.get()
+    if item is STOP:
+        return [], True
+
+    batch = [item]
+    deadline = time.monotonic() + max_wait
+    while len(batch) < batch_size:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            item = input_queue.get(timeout=remaining)
+        except queue.Empty:
+            break
+        if item is STOP:
+            return batch, True
+        batch.append(item)
+    return batch, False
+
+# Pipeline stage: stream unprocessed rows from the database into the decode queue
+# When image_ids is given only those images are read, otherwise every unprocessed image
+def reader_stage(db, decode_queue, image_ids=None, page_size=FETCH_PAGE_SIZE):
+    if image_ids is None:
+        unprocessed_count, images = get_unprocessed_images(db, page_size)
+        print(f"Found {unprocessed_count} unprocessed images")
+    else:
+        images = fetch_images(db, image_ids, page_size)
+    for row in images:
+        decode_queue.put(row)  # Blocks while the decoders are behind
+
+# Pipeline stage: decode image bytes and pass the decoded images on to inference
+# Images that cannot be decoded go straight to the writer, which records them as processed
+def decode_stage(decode_queue, infer_queue, write_queue):
+    while True:
+        item = decode_queue.get()
+        if item is STOP:
+            return
+        image_id, image_data, detection_date, incubator = item
+        image = decode_image(image_id, image_data)
+        if image is not None:
+            infer_queue.put((image_id, image, detection_date, incubator))
+        else:
+            write_queue.put((image_id, incubator, UNDECODABLE))
+
+# Pipeline stage: run batched inference and pass the grid results on to the writer
+def inference_stage(model, infer_queue, write_queue, batch_size=BATCH_SIZE, max_wait=BATCH_MAX_WAIT):
+    finished = False
+    while not finished:
+        batch, finished = collect_batch(infer_queue, batch_size, max_wait)
+        if batch:
+            for processed in infer_decoded_batch(model, batch):
+                write_queue.put(processed)
+
+# Pipeline stage: buffer the grid results and write them to the database in bulk
+def writer_stage(writer, write_queue):
+    while True:
+        try:
+            item = write_queue.get(timeout=writer.time_until_due())
+        except queue.Empty:
+            writer.flush_if_due()
+            continue
+        if item is STOP:
+            writer.flush()
+            return
+        image_id, incubator, egg_data = item
+        if egg_data is None:
+            print(f"Inference failed for image {image_id}, it is retried on the next run")
+        elif egg_data is UNDECODABLE:
+            writer.add(image_id, incubator, [], None)
+        else:
+            if not egg_data:
+                print(f"No eggs detected in image {image_id}")
+            writer.add(image_id, incubator, egg_data, len(egg_data))
+        writer.flush_if_due()
+
+# Bounded queue between two pipeline stages that remembers which consumer threads have taken STOP
+class StageQueue(queue.Queue):
+    def __init__(self, maxsize=0):
+        super().__init__(maxsize)
+        self.consumer = threading.local()
+
+    def get(self, block=True, timeout=None):
+        item = super().get(block, timeout)
+        if item is STOP:
+            self.consumer.stopped = True
+        return item
+
+    # Function to check whether the calling thread has already taken its STOP marker
+    def stopped(self):
+        return getattr(self.consumer, "stopped", False)
+
+# Function to run one pipeline stage in its thread
+# A stage that dies on an unexpected error logs it and keeps taking items off its input queue until
+# STOP, so the stages feeding it never block on a full queue and run_pipeline still shuts down.
+# Images lost this way are not saved, so they are selected again by the next run
+def run_stage(name, stage, input_queue, *args):
+    try:
+        stage(*args)
+    except Exception as e:
+        print(f"Error in the {name} stage, discarding the rest of its input: {str(e)}")
+        traceback.print_exc()
+        while input_queue is not None and not input_queue.stopped():
+            discard_item(input_queue.get())
+
+# Function to drop a pipeline item, handing back any letterbox buffer it holds
+def discard_item(item):
+    if isinstance(item, tuple):
+        for value in item:
+            release_image(value)
+
+# Function to track the peak depth of every pipeline queue and print the current depths
+# every interval seconds. A queue that stays full points at the stage reading from it as the bottleneck
+def report_queue_depths(queues, peaks, stop_event, interval=QUEUE_REPORT_INTERVAL, sample_interval=0.2):
+    last_report = time.monotonic()
+    while not stop_event.wait(sample_interval):
+        depths = {name: stage_queue.qsize() for name, stage_queue in queues.items()}
+        for name, depth in depths.items():
+            peaks[name] = max(peaks[name], depth)
+        if time.monotonic() - last_report >= interval:
+            last_report = time.monotonic()
+            print(f"Queue depths: {' '.join(f'{name}={depth}/{queues[name].maxsize}' for name, depth in depths.items())}")
+
+# Function to run the fetch -> decode -> infer -> write pipeline until all pending images are saved
+# The reader and writer check their connections out of the shared pool per page / per flush
+# Returns the set of image ids whose results were written; any other image is left unprocessed
+def run_pipeline(model, db, image_ids=None, decode_workers=DECODE_WORKERS,
+                 queue_size=PIPELINE_QUEUE_SIZE, batch_size=BATCH_SIZE, max_wait=BATCH_MAX_WAIT):
+    queues = {
+        "decode": StageQueue(maxsize=queue_size),
+        "infer": StageQueue(maxsize=queue_size),
+        "write": StageQueue(maxsize=queue_size),
+    }
+    peaks = {name: 0 for name in queues}
+    stop_reporting = threading.Event()
+    started = time.monotonic()
+    result_writer = ResultWriter(db)
+
+    reader = threading.Thread(
+        target=run_stage, args=("reader", reader_stage, None, db, queues["decode"], image_ids), daemon=True
+    )
+    decoders = [
+        threading.Thread(
+            target=run_stage,
+            args=("decode", decode_stage, queues["decode"], queues["decode"], queues["infer"], queues["write"]),
+            daemon=True
+        )
+        for _ in range(decode_workers)
+    ]
+    inference = threading.Thread(
+        target=run_stage,
+        args=("inference", inference_stage, queues["infer"], model, queues["infer"], queues["write"], batch_size, max_wait),
+        daemon=True
+    )
+    writer = threading.Thread(
+        target=run_stage, args=("writer", writer_stage, queues["write"], result_writer, queues["write"]), daemon=True
+    )
+    reporter = threading.Thread(target=report_queue_depths, args=(queues, peaks, stop_reporting), daemon=True)
+
+    for thread in [reader, *decoders, inference, writer, reporter]:
+        thread.start()
+
+    # Shut the stages down front to back, so every queued item is drained before its consumer stops
+    reader.join()
+    for _ in decoders:
+        queues["decode"].put(STOP)
+    for decoder in decoders:
+        decoder.join()
+    queues["infer"].put(STOP)
+    inference.join()
+    queues["write"].put(STOP)
+    writer.join()
+
+    stop_reporting.set()
+    reporter.join()
+    peak_depths = " ".join(f"{name}={depth}/{queues[name].maxsize}" for name, depth in peaks.items())
+    print(f"Pipeline finished in {time.monotonic() - started:.1f}s, saved {len(result_writer.written)} images, "
+          f"peak queue depths: {peak_depths}")
+    dump_metrics()
+    return result_writer.written
+
+# Function to write the collected stage timings to METRICS_JSON_PATH
+def dump_metrics(path=None):
+    if not metrics.REGISTRY.enabled:
+        return
+    path = path or METRICS_JSON_PATH
+    try:
+        metrics.REGISTRY.dump_json(path)
+    except OSError as e:
+        print(f"Error writing metrics to {path}: {str(e)}")
+
+# Function to get the part of a pool worker's shard that decides which images it owns, or None
+# outside a pool; a mark is only valid for the same worker count and shard key
+def shard_layout(shard):
+    if shard is None:
+        return None
+    _, workers, shard_by = shard
+    return [workers, shard_by]
+
+# Function to read the persisted high-water mark, or None on the first start
+# A mark saved under another shard layout is ignored: images below it that were pending in another
+# worker's shard may now belong to this one, so the backlog is scanned again
+def load_high_water_mark(path=STATE_PATH, shard=None):
+    try:
+        with open(path) as f:
+            state = json.load(f)
+        if state.get("shard") != shard_layout(shard):
+            print(f"Shard layout changed from {state.get('shard')} to {shard_layout(shard)}, rescanning the backlog")
+            return None
+        return state["high_water_mark"]
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Error reading processor state from {path}: {str(e)}")
+        return None
+
+# Function to persist the high-water mark atomically, so a crash never leaves a half-written file
+def save_high_water_mark(high_water_mark, path=STATE_PATH, shard=None):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump({"high_water_mark": high_water_mark, "shard": shard_layout(shard),
+                   "updated": datetime.now().isoformat()}, f)
+    os.replace(temp_path, path)
+
+# Function to get the high-water mark after a run over image_ids: last_id, or just below the first
+# image that was not written, so that one is polled again. Images above it that were written are
+# excluded by the poll query and not processed twice
+def next_high_water_mark(last_id, image_ids, written):
+    failed = [image_id for image_id in image_ids if image_id not in written]
+    if not failed:
+        return last_id
+    print(f"{len(failed)} images were not saved, retrying from image {min(failed)}")
+    return min(last_id, min(failed) - 1)
+
+# Function to keep the model loaded and process new images as they arrive
+# Only unprocessed rows above the high-water mark are read; the mark is saved after their results are
+# written and never moves past an image that failed, so a restart replays at most one poll's worth of
+# images (harmless thanks to the upsert) and failed images are retried, backing off while they keep failing.
+# A pool worker passes its shard and only processes its own share of the new images
+def run_daemon(model, db, stop_event, state_path=STATE_PATH, min_interval=POLL_MIN_INTERVAL,
+               max_interval=POLL_MAX_INTERVAL, shard=None):
+    high_water_mark = load_high_water_mark(state_path, shard)
+    if high_water_mark is None:
+        # First start (or a new shard layout): work off the existing backlog, then continue from the newest image
+        newest = db.run(select_newest_image_id)
+        image_ids = get_unprocessed_image_ids(db, shard)
+        written = run_pipeline(model, db, image_ids)
+        high_water_mark = next_high_water_mark(newest or 0, image_ids, written)
+        save_high_water_mark(high_water_mark, state_path, shard)
+    print(f"Watching for images above id {high_water_mark}")
+
+    interval = min_interval
+    while not stop_event.is_set():
+        try:
+            newest = db.run(select_newest_image_id)
+            rows = db.run(select_image_ids_above, high_water_mark) if newest and newest > high_water_mark else []
+        except Error as e:
+            print(f"Error polling for new images: {str(e)}")
+            rows = []
+
+        if rows:
+            image_ids = shard_image_ids(rows, shard)
+            written = set()
+            if image_ids:
+                print(f"Found {len(image_ids)} new images")
+                written = run_pipeline(model, db, image_ids)
+            # Other shards' images are skipped, not re-polled
+            high_water_mark = next_high_water_mark(rows[-1][0], image_ids, written)
+            save_high_water_mark(high_water_mark, state_path, shard)
+            interval = min_interval if written or not image_ids else min(interval * 2, max_interval)
+        else:
+            interval = min(interval * 2, max_interval)
+
+        stop_event.wait(interval)
+    print("Daemon stopped")
+
+# Function to pin a pool worker to its own slice of the CPU cores
+# The thread count environment variables are set by the parent before the workers start, so
+# OpenMP/BLAS size their pools correctly; load_model passes the count to the exported model's runtime
+# and affinity bounds anything else that ignores them
+def pin_worker_threads(index, threads):
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+    if cores:
+        start = (index * threads) % len(cores)
+        os.sched_setaffinity(0, {cores[(start + i) % len(cores)] for i in range(min(threads, len(cores)))})
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+
+# Function run in each pool worker process: load its own model and process its shard
+def run_worker(index, workers, shard_by, threads, daemon):
+    global METRICS_JSON_PATH
+    METRICS_JSON_PATH = f"{METRICS_JSON_PATH}.{index}"
+    pin_worker_threads(index, threads)
+    shard = (index, workers, shard_by)
+
+    model = load_model(MODEL_PATH, threads=threads)
+    if model is None:
+        return
+    db = connect_to_database()
+    if db is None:
+        return
+    try:
+        if daemon:
+            stop_event = threading.Event()
+            signal.signal(signal.SIGTERM, lambda sig, frame: stop_event.set())
+            run_daemon(model, db, stop_event, state_path=f"{STATE_PATH}.{index}", shard=shard)
+        else:
+            image_ids = get_unprocessed_image_ids(db, shard)
+            print(f"Worker {index}: {len(image_ids)} unprocessed images")
+            run_pipeline(model, db, image_ids)
+    except KeyboardInterrupt:
+        print(f"Worker {index} interrupted")
     finally:
-        cursor.close()
+        db.close()
+
+# Function to start the worker pool and wait for it
+# Workers are spawned rather than forked, so each one starts its own runtime with the thread limits
+def run_workers(workers, shard_by=SHARD_BY, threads=WORKER_THREADS, daemon=False):
+    if threads <= 0:
+        cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+        threads = max(1, cores // workers)
+    for name in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[name] = str(threads)
+
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=run_worker, args=(index, workers, shard_by, threads, daemon), name=f"worker-{index}")
+        for index in range(workers)
+    ]
+    def stop_workers(sig, frame):
+        for process in processes:
+            process.terminate()  # Each worker finishes its current pipeline run on SIGTERM
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    print(f"Starting {workers} workers sharded by {shard_by}, {threads} threads each")
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
 
 # Main function to load the model, connect to the database, and process images
 def main():
-    model_path = "/home/pi/aws-computer-vision-industrial-egg-fertility-sorting-system/egg_detection_yolov8n_final.pt"
-    model = load_model(model_path)
-    if model is None:
+    parser = argparse.ArgumentParser(description="Detect eggs in stored tray images and save their fertility status")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running and process new images as they arrive instead of exiting")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="number of model processes sharing the pending images")
+    parser.add_argument("--shard-by", choices=["id", "incubator"], default=SHARD_BY,
+                        help="split images between workers by id modulo workers, or by incubator")
+    args = parser.parse_args()
+
+    db = connect_to_database()
+    if db is None:
+        return
+
+    # Without the unique key the upsert would insert duplicates (MySQL) or fail outright (SQLite)
+    if not (ensure_result_unique_key(db) and ensure_image_incubator_column(db)
+            and ensure_processed_images_table(db)):
+        db.close()
+        return
+    # Without image_hash every page select would fail and the run would skip every image
+    if IMAGE_STORE_ENABLED and not ensure_image_store_columns(db):
+        db.close()
         return
 
-    connection = connect_to_database()
-    if connection is None:
+    if args.workers > 1:
+        db.close()
+        # Export the model once here, so the workers find it in the cache instead of all exporting it
+        if load_model(MODEL_PATH, warmup=False) is None:
+            return
+        try:
+            run_workers(args.workers, args.shard_by, daemon=args.daemon)
+        except KeyboardInterrupt:
+            print("Interrupted")
         return
 
-    unprocessed_images = get_unprocessed_images(connection)
-    print(f"Found {len(unprocessed_images)} unprocessed images")
+    model = load_model(MODEL_PATH, threads=WORKER_THREADS or None)
+    if model is None:
+        db.close()
+        return
 
-    for image_id, image_data, detection_date in unprocessed_images:
-        egg_data = process_image(model, image_id, image_data, detection_date)
-        if egg_data:
-            save_results_to_database(connection, egg_data)
-            print(f"Processed and saved image {image_id}")
+    try:
+        if args.daemon:
+            stop_event = threading.Event()
+            signal.signal(signal.SIGTERM, lambda sig, frame: stop_event.set())
+            run_daemon(model, db, stop_event)
         else:
-            print(f"No eggs detected in image {image_id}")
-
-    connection.close()
+            run_pipeline(model, db)
+    except KeyboardInterrupt:
+        print("Interrupted")
+    finally:
+        db.close()
 
 if __name__ == "__main__":
     main()
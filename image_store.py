@@ -0,0 +1,197 @@
+import io
+import os
+import mmap
+import hashlib
+import argparse
+import threading
+from mysql.connector import Error
+from PIL import Image
+from config import get_setting
+
+# Content-addressed image store: each JPEG is written once to IMAGE_STORE_DIR/ab/cd/<sha256>.jpg and
+# the images row keeps only image_hash, width, height and a small thumbnail (image_data stays NULL).
+# Identical frames share one file. With image_store_enabled = true the processors read stored files
+# through mmap whenever image_data is NULL
+IMAGE_STORE_ENABLED = get_setting("store", "image_store_enabled", False, bool)
+IMAGE_STORE_DIR = get_setting("store", "image_store_dir", "image_store")
+THUMBNAIL_SIZE = (160, 120)
+THUMBNAIL_QUALITY = 70
+
+# Columns added to images by add_image_store_columns, as (name, MySQL type, SQLite type)
+STORE_COLUMNS = [
+    ("image_hash", "CHAR(64) NULL", "TEXT"),
+    ("width", "INT NULL", "INTEGER"),
+    ("height", "INT NULL", "INTEGER"),
+    ("thumbnail", "BLOB NULL", "BLOB"),
+    ("incubatorNo", "VARCHAR(64) NULL", "TEXT"),  # Also added by image_processing; needed by save_frame
+]
+
+class ImageStore:
+    def __init__(self, root=IMAGE_STORE_DIR):
+        self.root = root
+
+    # Function to get the file path of a hash, sharded two levels deep so no directory grows too large
+    def path_for(self, image_hash):
+        return os.path.join(self.root, image_hash[:2], image_hash[2:4], f"{image_hash}.jpg")
+
+    # Function to store an image and return its sha256; an image that is already stored is not rewritten
+    def put(self, data):
+        image_hash = hashlib.sha256(data).hexdigest()
+        path = self.path_for(image_hash)
+        if os.path.exists(path):
+            return image_hash
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)  # Readers never see a partially written file
+        return image_hash
+
+    # Function to map a stored image read-only; the mmap can be passed to PIL like a file
+    def open(self, image_hash):
+        with open(self.path_for(image_hash), "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def exists(self, image_hash):
+        return os.path.exists(self.path_for(image_hash))
+
+# Function to get (width, height, thumbnail JPEG bytes) of an encoded image
+# draft() lets libjpeg decode at 1/8 scale, so the thumbnail costs a fraction of a full decode
+def image_metadata(data):
+    image = Image.open(io.BytesIO(data))
+    width, height = image.size
+    image.draft("RGB", THUMBNAIL_SIZE)
+    image = image.convert("RGB")
+    image.thumbnail(THUMBNAIL_SIZE)
+    thumbnail = io.BytesIO()
+    image.save(thumbnail, "JPEG", quality=THUMBNAIL_QUALITY)
+    return width, height, thumbnail.getvalue()
+
+# Function to add the image store columns to images, and make image_data nullable, where needed
+def add_image_store_columns(connection, dialect):
+    cursor = connection.cursor()
+    try:
+        if dialect == "sqlite":
+            cursor.execute("PRAGMA table_info(images)")
+            existing = {row[1] for row in cursor.fetchall()}
+            for name, _, sqlite_type in STORE_COLUMNS:
+                if name not in existing:
+                    cursor.execute(f"ALTER TABLE images ADD COLUMN {name} {sqlite_type}")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_image_hash ON images (image_hash)")
+            connection.commit()
+            return
+
+        cursor.execute("""
+            SELECT COLUMN_NAME, COLUMN_TYPE, IS_NULLABLE FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'images'
+        """)
+        existing = {name: (column_type, nullable) for name, column_type, nullable in cursor.fetchall()}
+        changes = [f"ADD COLUMN {name} {mysql_type}" for name, mysql_type, _ in STORE_COLUMNS if name not in existing]
+        if "image_hash" not in existing:
+            changes.append("ADD INDEX idx_image_hash (image_hash)")
+        if existing.get("image_data", (None, "YES"))[1] == "NO":
+            changes.append(f"MODIFY image_data {existing['image_data'][0]} NULL")
+        if changes:
+            cursor.execute(f"ALTER TABLE images {', '.join(changes)}")
+            print(f"Updated images for the image store: {', '.join(changes)}")
+    finally:
+        cursor.close()
+
+# Function to make sure images has the image store columns
+def ensure_image_store_columns(db):
+    try:
+        db.run(add_image_store_columns, db.dialect)
+        return True
+    except Error as e:
+        print(f"Error adding image store columns to images: {str(e)}")
+        return False
+
+# Function to insert an images row for a stored image, returning its id
+def insert_stored_image(connection, image_hash, width, height, thumbnail, detection_date, incubator):
+    cursor = connection.cursor()
+    try:
+        cursor.execute("""
+            INSERT INTO images (image_data, detection_Date, image_hash, width, height, thumbnail, incubatorNo)
+            VALUES (NULL, %s, %s, %s, %s, %s, %s)
+        """, (detection_date, image_hash, width, height, thumbnail, incubator))
+        connection.commit()
+        return cursor.lastrowid
+    finally:
+        cursor.close()
+
+# Function to write a frame to the store and register it in images, returning the new row id
+def save_frame(db, store, data, detection_date, incubator):
+    image_hash = store.put(data)
+    width, height, thumbnail = image_metadata(data)
+    return db.run(insert_stored_image, image_hash, width, height, thumbnail, detection_date, incubator,
+                  idempotent=False)
+
+# Function to select the next rows that still hold their image in image_data
+def select_blob_page(connection, after_id, page_size):
+    cursor = connection.cursor(buffered=False)
+    try:
+        cursor.execute(
+            "SELECT id, image_data FROM images WHERE image_data IS NOT NULL AND id > %s ORDER BY id LIMIT %s",
+            (after_id, page_size)
+        )
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+# Function to point rows at their stored files and drop their blobs, in one transaction
+def move_blobs_to_store(connection, rows):
+    cursor = connection.cursor()
+    try:
+        cursor.executemany("""
+            UPDATE images SET image_hash = %s, width = %s, height = %s, thumbnail = %s, image_data = NULL
+            WHERE id = %s
+        """, rows)
+        connection.commit()
+    finally:
+        cursor.close()
+
+# Function to move existing image_data blobs into the store, page by page
+# Files are written before their rows are updated, so an interrupted run can simply be restarted
+def migrate_blobs(db, store, page_size=50):
+    moved = 0
+    after_id = 0
+    while True:
+        page = db.run(select_blob_page, after_id, page_size)
+        if not page:
+            break
+        rows = []
+        for image_id, image_data in page:
+            try:
+                image_data = bytes(image_data)
+                image_hash = store.put(image_data)
+                width, height, thumbnail = image_metadata(image_data)
+                rows.append((image_hash, width, height, thumbnail, image_id))
+            except (OSError, ValueError) as e:
+                print(f"Error moving image {image_id} to the store, leaving its blob in place: {str(e)}")
+        if rows:
+            db.run(move_blobs_to_store, rows)
+        moved += len(rows)
+        after_id = page[-1][0]
+        print(f"Moved {moved} images to {store.root}")
+    return moved
+
+def main():
+    parser = argparse.ArgumentParser(description="Prepare the images table for the image store and move blobs into it")
+    parser.add_argument("--migrate", action="store_true", help="also move existing image_data blobs into the store")
+    parser.add_argument("--page-size", type=int, default=50)
+    args = parser.parse_args()
+
+    from database import DatabasePool
+    db = DatabasePool()
+    if not db.is_healthy():
+        return
+    try:
+        if ensure_image_store_columns(db) and args.migrate:
+            migrate_blobs(db, ImageStore(), args.page_size)
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+# Function to get the cache key of an image: the SHA-256 of its encoded bytes
+def image_hash(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+# Function to get the SHA-256 of a file, read in 1 MB chunks so large model files are not loaded at once
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Persistent cache of inference results keyed by (image content hash, model version)
+# Results are stored as JSON in a local SQLite file; when they exceed max_bytes the least
+# recently used entries are evicted
+class InferenceCache:
+    def __init__(self, path="inference_cache.sqlite3", max_bytes=50 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                image_hash TEXT NOT NULL,
+                model_version TEXT NOT NULL,
+                result TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (image_hash, model_version)
+            )
+        """)
+        self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+
+    # Function to look up a cached result, returning None on a miss
+    def get(self, image_hash, model_version):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT result FROM results WHERE image_hash = ? AND model_version = ?", (image_hash, model_version)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.connection.execute(
+                "UPDATE results SET last_used = ? WHERE image_hash = ? AND model_version = ?",
+                (time.time(), image_hash, model_version)
+            )
+            self.connection.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    # Function to store a result, evicting the least recently used entries when over max_bytes
+    def put(self, image_hash, model_version, result):
+        encoded = json.dumps(result)
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO results (image_hash, model_version, result, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                (image_hash, model_version, encoded, len(encoded), time.time())
+            )
+            total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+            if total > self.max_bytes:
+                rows = self.connection.execute(
+                    "SELECT image_hash, model_version, size FROM results ORDER BY last_used"
+                ).fetchall()
+                for old_hash, old_version, size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    self.connection.execute(
+                        "DELETE FROM results WHERE image_hash = ? AND model_version = ?", (old_hash, old_version)
+                    )
+                    total -= size
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
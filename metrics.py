@@ -0,0 +1,155 @@
+import json
+import time
+import threading
+from config import get_setting
+
+# Set metrics_enabled = false to turn every timer, counter and histogram into a no-op
+METRICS_ENABLED = get_setting("metrics", "metrics_enabled", True, bool)
+
+# Histogram bucket upper bounds in seconds, from 1 ms to 10 s
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Context manager recording the time spent inside it into a histogram
+class Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started)
+        return False
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter", f"{self.name} {self.value}"]
+
+    def to_dict(self):
+        return {"type": "counter", "value": self.value}
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.count += 1
+            self.sum += value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+    # Function to time a block: with histogram.time(): ...
+    def time(self):
+        return Timer(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            cumulative = 0
+            for bound, count in zip(self.buckets, self.counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+            lines.append(f"{self.name}_sum {self.sum}")
+            lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "type": "histogram",
+                "count": self.count,
+                "sum": self.sum,
+                "mean": self.sum / self.count if self.count else None,
+                "buckets": {str(bound): count for bound, count in zip(self.buckets, self.counts)},
+            }
+
+# Stand-in returned for every metric while metrics are disabled
+class NullMetric:
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+    def time(self):
+        return NULL_TIMER
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+NULL_METRIC = NullMetric()
+NULL_TIMER = NullTimer()
+
+class MetricsRegistry:
+    def __init__(self, enabled=METRICS_ENABLED):
+        self.enabled = enabled
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    # Function to get or create a metric; the same name always returns the same object
+    def _register(self, name, factory):
+        if not self.enabled:
+            return NULL_METRIC
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = factory()
+            return self.metrics[name]
+
+    def counter(self, name, help_text):
+        return self._register(name, lambda: Counter(name, help_text))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self._register(name, lambda: Histogram(name, help_text, buckets))
+
+    # Function to render every metric in the Prometheus text exposition format
+    def render_prometheus(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self):
+        with self.lock:
+            metrics = dict(self.metrics)
+        return {name: metric.to_dict() for name, metric in metrics.items()}
+
+    # Function to write every metric to a JSON file
+    def dump_json(self, path):
+        with open(path, "w") as f:
+            json.dump({"timestamp": time.time(), "metrics": self.to_dict()}, f, indent=2)
+
+# Registry shared by every module of a process
+REGISTRY = MetricsRegistry()
+
+def counter(name, help_text):
+    return REGISTRY.counter(name, help_text)
+
+def histogram(name, help_text, buckets=DEFAULT_BUCKETS):
+    return REGISTRY.histogram(name, help_text, buckets)
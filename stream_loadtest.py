@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import asyncio
+import argparse
+
+# Function to read the CPU seconds (user + system) used so far by a process
+def process_cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    # Fields after the command name start at field 3 (state); utime and stime are fields 14 and 15
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+# Function to read the resident set size of a process in MB
+def process_rss_mb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+# Function to act as one dashboard viewer, counting the frames received until the deadline
+async def viewer(host, port, deadline, counts, index):
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+    except OSError as e:
+        print(f"Viewer {index} could not connect: {e}")
+        return
+    writer.write(b"GET /stream.mjpg HTTP/1.0\r\n\r\n")
+    await writer.drain()
+
+    boundary = b'--FRAME'
+    tail = b''
+    try:
+        while time.monotonic() < deadline:
+            try:
+                chunk = await asyncio.wait_for(reader.read(65536), timeout=max(0.01, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                break
+            if not chunk:
+                break
+            data = tail + chunk
+            counts[index] += data.count(boundary)
+            # Keep one byte less than a boundary: enough to spot one split across two reads, but never a
+            # whole boundary, which would be counted again with the next read
+            tail = data[-(len(boundary) - 1):]
+    finally:
+        writer.close()
+
+# Function to hold a number of viewers connected for a while and measure the server meanwhile
+async def run_step(host, port, viewers, duration, pid):
+    counts = [0] * viewers
+    deadline = time.monotonic() + duration
+    cpu_before = process_cpu_seconds(pid) if pid else None
+    tasks = [asyncio.create_task(viewer(host, port, deadline, counts, i)) for i in range(viewers)]
+
+    peak_rss = 0.0
+    while time.monotonic() < deadline:
+        if pid:
+            peak_rss = max(peak_rss, process_rss_mb(pid))
+        await asyncio.sleep(0.5)
+    await asyncio.gather(*tasks)
+
+    step = {
+        "viewers": viewers,
+        "frames_per_viewer_per_s": round(sum(counts) / viewers / duration, 2),
+        "slowest_viewer_fps": round(min(counts) / duration, 2),
+    }
+    if pid:
+        step["server_cpu_percent"] = round((process_cpu_seconds(pid) - cpu_before) / duration * 100, 1)
+        step["server_peak_rss_mb"] = round(peak_rss, 1)
+    return step
+
+# Main function to step through the viewer counts and print CPU and memory against viewer count
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the MJPEG streaming server with many concurrent viewers")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7123)
+    parser.add_argument("--viewers", default="1,5,10,25,50", help="comma separated viewer counts to step through")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per step")
+    parser.add_argument("--pid", type=int, default=None, help="pid of the streaming server to sample CPU and RSS from")
+    parser.add_argument("--output", default=None, help="optional JSON results file")
+    args = parser.parse_args()
+
+    steps = []
+    print(f"{'viewers':>8} {'fps/viewer':>11} {'min fps':>8} {'cpu %':>7} {'rss MB':>8}")
+    for viewers in [int(v) for v in args.viewers.split(",")]:
+        step = asyncio.run(run_step(args.host, args.port, viewers, args.duration, args.pid))
+        steps.append(step)
+        print(f"{step['viewers']:>8} {step['frames_per_viewer_per_s']:>11} {step['slowest_viewer_fps']:>8} "
+              f"{step.get('server_cpu_percent', '-'):>7} {step.get('server_peak_rss_mb', '-'):>8}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"host": args.host, "port": args.port, "duration": args.duration, "steps": steps}, f, indent=2)
+        print(f"Results saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
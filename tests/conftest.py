@@ -0,0 +1,55 @@
+import os
+import sys
+
+# The modules under test are the scripts at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from database import DatabasePool
+
+# SQLite stand-in with the images and fertility_status tables plus everything main() adds to them
+@pytest.fixture
+def stand_in_db(tmp_path):
+    import image_processing
+    db = DatabasePool(backend="sqlite", sqlite_path=str(tmp_path / "intelliegg.sqlite3"))
+
+    def create(connection):
+        cursor = connection.cursor()
+        try:
+            cursor.execute("CREATE TABLE images (id INTEGER PRIMARY KEY, image_data BLOB, detection_Date TEXT)")
+            cursor.execute("""
+                CREATE TABLE fertility_status (
+                    id INTEGER PRIMARY KEY, image_id INTEGER, `row_number` INTEGER, column_number INTEGER,
+                    status TEXT, confidence REAL, detection_date TEXT, incubatorNo TEXT
+                )
+            """)
+            cursor.executemany(
+                "INSERT INTO images (id, image_data, detection_Date) VALUES (%s, %s, %s)",
+                [(image_id, b"", "2026-01-01 00:00:00") for image_id in (1, 2, 3)]
+            )
+            connection.commit()
+        finally:
+            cursor.close()
+
+    db.run(create)
+    assert image_processing.ensure_result_unique_key(db)
+    assert image_processing.ensure_image_incubator_column(db)
+    assert image_processing.ensure_processed_images_table(db)
+    yield db
+    db.close()
+
+# Function returning every row of a query against the stand-in
+@pytest.fixture
+def fetch_all(stand_in_db):
+    def fetch(sql):
+        def select(connection):
+            cursor = connection.cursor()
+            try:
+                cursor.execute(sql)
+                return cursor.fetchall()
+            finally:
+                cursor.close()
+
+        return stand_in_db.run(select)
+
+    return fetch
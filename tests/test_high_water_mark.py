@@ -0,0 +1,25 @@
+import image_processing
+
+def test_mark_moves_to_the_last_id_when_every_image_was_written():
+    assert image_processing.next_high_water_mark(10, [7, 8, 10], {7, 8, 10}) == 10
+
+def test_mark_stops_below_the_first_image_that_was_not_written():
+    assert image_processing.next_high_water_mark(10, [7, 8, 10], {7, 10}) == 7
+    assert image_processing.next_high_water_mark(10, [7, 8, 10], set()) == 6
+
+def test_a_failed_write_is_not_reported_as_written(stand_in_db, fetch_all):
+    writer = image_processing.ResultWriter(stand_in_db)
+    writer.add(1, "incubator1", [(1, 1, 1, "fertile", 0.9, "2026-01-01")], 1)
+    fetch_all("DROP TABLE processed_images")  # The marker insert fails, rolling back the whole flush
+    writer.flush()
+
+    assert writer.written == set()
+    assert fetch_all("SELECT * FROM fertility_status") == []
+
+def test_mark_saved_under_another_shard_layout_is_ignored(tmp_path):
+    path = str(tmp_path / "processor_state.json.0")
+    image_processing.save_high_water_mark(100, path, (0, 2, "id"))
+
+    assert image_processing.load_high_water_mark(path, (0, 2, "id")) == 100
+    assert image_processing.load_high_water_mark(path, (0, 3, "id")) is None
+    assert image_processing.load_high_water_mark(path, (0, 2, "incubator")) is None
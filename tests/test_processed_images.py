@@ -0,0 +1,20 @@
+import image_processing
+
+def test_processed_images_are_not_selected_again(stand_in_db, fetch_all):
+    writer = image_processing.ResultWriter(stand_in_db)
+    writer.add(1, "incubator1", [(1, 1, 1, "fertile", 0.9, "2026-01-01")], 1)
+    writer.add(2, "incubator1", [], 0)  # No eggs detected
+    writer.flush()
+    writer.add(2, "incubator1", [], None)  # Replayed as undecodable
+    writer.flush()
+
+    assert image_processing.get_unprocessed_image_ids(stand_in_db) == [3]
+    assert fetch_all("SELECT image_id, egg_count FROM processed_images ORDER BY image_id") == [(1, 1), (2, None)]
+
+def test_images_above_the_high_water_mark_skip_processed_ones(stand_in_db):
+    writer = image_processing.ResultWriter(stand_in_db)
+    writer.add(2, "incubator1", [], 0)
+    writer.flush()
+
+    ids = stand_in_db.run(image_processing.select_image_ids_above, 1, "incubator1")
+    assert [row[0] for row in ids] == [3]
@@ -0,0 +1,23 @@
+import image_processing
+
+RESULTS_QUERY = """
+    SELECT image_id, `row_number`, column_number, status, confidence, incubatorNo
+    FROM fertility_status ORDER BY image_id, `row_number`, column_number
+"""
+
+def test_replaying_an_image_overwrites_its_cells(stand_in_db, fetch_all):
+    egg_data = [(1, 1, 1, "fertile", 0.9, "2026-01-01"), (1, 1, 2, "infertile", 0.8, "2026-01-01")]
+    assert image_processing.save_results_to_database(stand_in_db, egg_data, "incubator2")
+    replay = [(1, 1, 1, "infertile", 0.7, "2026-01-02"), (1, 1, 2, "infertile", 0.8, "2026-01-02")]
+    assert image_processing.save_results_to_database(stand_in_db, replay, "incubator2")
+
+    assert fetch_all(RESULTS_QUERY) == [(1, 1, 1, "infertile", 0.7, "incubator2"), (1, 1, 2, "infertile", 0.8, "incubator2")]
+
+def test_one_upsert_writes_rows_of_several_images_and_incubators(stand_in_db, fetch_all):
+    writer = image_processing.ResultWriter(stand_in_db, max_rows=100, max_delay=60)
+    writer.add(1, "incubator1", [(1, 1, 1, "fertile", 0.9, "2026-01-01")], 1)
+    writer.add(2, "incubator2", [(2, 3, 4, "fertile", 0.6, "2026-01-01")], 1)
+    writer.add(1, "incubator1", [(1, 1, 1, "infertile", 0.5, "2026-01-01")], 1)  # Replayed before the flush
+    writer.flush()
+
+    assert fetch_all(RESULTS_QUERY) == [(1, 1, 1, "infertile", 0.5, "incubator1"), (2, 3, 4, "fertile", 0.6, "incubator2")]
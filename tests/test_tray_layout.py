@@ -0,0 +1,87 @@
+import json
+import numpy as np
+import pytest
+from tray_layout import TrayLayout, load_tray_layouts
+
+IMAGE_SIZE = (800, 700)
+
+# Function to build a box of the given size around a center point
+def box(x, y, half=10):
+    return [x - half, y - half, x + half, y + half]
+
+def test_boxes_map_to_rows_and_columns():
+    layout = TrayLayout(rows=7, columns=8)
+    rows, cols, conf, cls = layout.assign([box(50, 50), box(750, 650), box(450, 250)], [0.9, 0.8, 0.7], [0, 1, 0], IMAGE_SIZE)
+
+    assert list(zip(rows.tolist(), cols.tolist())) == [(0, 0), (2, 4), (6, 7)]
+    assert conf.tolist() == [0.9, 0.7, 0.8]
+    assert cls.tolist() == [0, 0, 1]
+
+def test_centers_on_the_right_and_bottom_edge_belong_to_the_last_cell():
+    layout = TrayLayout(rows=7, columns=8)
+    rows, cols, _, _ = layout.assign([box(800, 700), box(800, 0), box(0, 700)], [0.9, 0.9, 0.9], [0, 0, 0], IMAGE_SIZE)
+
+    assert sorted(zip(rows.tolist(), cols.tolist())) == [(0, 7), (6, 0), (6, 7)]
+
+def test_centers_on_a_cell_boundary_go_to_the_next_cell():
+    layout = TrayLayout(rows=7, columns=8)
+    rows, cols, _, _ = layout.assign([box(100, 100)], [0.9], [0], IMAGE_SIZE)
+
+    assert (rows.tolist(), cols.tolist()) == ([1], [1])
+
+def test_most_confident_box_wins_a_shared_cell():
+    layout = TrayLayout(rows=7, columns=8)
+    rows, cols, conf, cls = layout.assign(
+        [box(40, 40), box(60, 60), box(50, 45), box(150, 40)], [0.4, 0.95, 0.6, 0.5], [1, 0, 1, 1], IMAGE_SIZE
+    )
+
+    assert list(zip(rows.tolist(), cols.tolist())) == [(0, 0), (0, 1)]
+    assert conf.tolist() == [0.95, 0.5]
+    assert cls.tolist() == [0, 1]
+
+def test_no_boxes_gives_empty_arrays():
+    rows, cols, conf, cls = TrayLayout().assign(np.zeros((0, 4)), [], [], IMAGE_SIZE)
+
+    assert len(rows) == len(cols) == len(conf) == len(cls) == 0
+
+def test_boxes_outside_the_calibrated_corners_are_dropped():
+    corners = [[0.1, 0.1], [0.9, 0.1], [0.9, 0.9], [0.1, 0.9]]
+    layout = TrayLayout(rows=2, columns=2, corners=corners)
+    rows, cols, _, _ = layout.assign([box(40, 40), box(240, 210), box(560, 490), box(780, 350)],
+                                     [0.9, 0.9, 0.9, 0.9], [0, 0, 0, 0], IMAGE_SIZE)
+
+    assert list(zip(rows.tolist(), cols.tolist())) == [(0, 0), (1, 1)]
+
+def test_perspective_corners_map_a_trapezoid_onto_the_grid():
+    # Tray photographed at an angle: the far (top) edge looks narrower than the near one
+    corners = [[0.3, 0.0], [0.7, 0.0], [1.0, 1.0], [0.0, 1.0]]
+    layout = TrayLayout(rows=2, columns=2, corners=corners)
+    # Near the top the tray only spans x = 240..560, so x = 300 is already in the left half
+    rows, cols, _, _ = layout.assign([box(300, 20), box(520, 20), box(100, 680)], [0.9, 0.9, 0.9], [0, 0, 0], IMAGE_SIZE)
+
+    assert list(zip(rows.tolist(), cols.tolist())) == [(0, 0), (0, 1), (1, 0)]
+    rows, _, _, _ = layout.assign([box(200, 20)], [0.9], [0], IMAGE_SIZE)
+    assert len(rows) == 0
+
+def test_invalid_corners_are_rejected():
+    with pytest.raises(ValueError):
+        TrayLayout(corners=[[0, 0], [1, 0], [1, 1]])
+
+def test_incubators_without_an_entry_use_the_default_layout(tmp_path):
+    path = tmp_path / "tray_layouts.json"
+    path.write_text(json.dumps({
+        "default": {"rows": 6, "columns": 5},
+        "incubators": {"incubator2": {"rows": 2, "columns": 2}},
+    }))
+    layouts = load_tray_layouts(str(path))
+
+    assert (layouts["default"].rows, layouts["default"].columns) == (6, 5)
+    assert (layouts["incubator2"].rows, layouts["incubator2"].columns) == (2, 2)
+    assert "incubator1" not in layouts
+
+def test_a_broken_layout_file_falls_back_to_the_default_grid(tmp_path):
+    path = tmp_path / "tray_layouts.json"
+    path.write_text("{not json")
+    layouts = load_tray_layouts(str(path))
+
+    assert (layouts["default"].rows, layouts["default"].columns) == (7, 8)
@@ -0,0 +1,120 @@
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import requests
+from upload_spool import UploadSpool
+
+# Local stand-in for the upload endpoint: answers with the queued status codes (then 200) and
+# records every request it receives
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like the real server
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        server = self.server
+        with server.lock:
+            status = server.statuses.pop(0) if server.statuses else 200
+            server.requests.append((time.monotonic(), self.client_address[1], body, status))
+        content = b'{"success": true}'
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def stand_in_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.lock = threading.Lock()
+    server.statuses = []
+    server.requests = []
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/fertility_check.php"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def spool(tmp_path):
+    spool = UploadSpool(str(tmp_path / "spool.sqlite3"), batch_size=3, retry_delay=0.05, retry_max_delay=1.0, timeout=2)
+    yield spool
+    spool.stop()
+
+# Function to wait until the spool is empty, failing the test after timeout seconds
+def wait_until_drained(spool, timeout=10):
+    deadline = time.monotonic() + timeout
+    while spool.pending()[0]:
+        assert time.monotonic() < deadline, f"spool still holds {spool.pending()[0]} uploads"
+        time.sleep(0.02)
+
+def test_uploads_are_sent_in_order_over_one_connection(stand_in_server, spool):
+    bodies = [f"frame {i}".encode() for i in range(7)]
+    for body in bodies:
+        spool.enqueue(stand_in_server.url, body, "image/jpeg")
+    spool.start()
+    wait_until_drained(spool)
+
+    assert [body for _, _, body, _ in stand_in_server.requests] == bodies
+    assert len({port for _, port, _, _ in stand_in_server.requests}) == 1
+
+def test_server_errors_are_retried_with_backoff(stand_in_server, spool):
+    stand_in_server.statuses = [503, 503, 503]
+    spool.enqueue(stand_in_server.url, b"frame", "image/jpeg")
+    spool.start()
+    wait_until_drained(spool)
+
+    times = [at for at, _, _, _ in stand_in_server.requests]
+    assert [status for _, _, _, status in stand_in_server.requests] == [503, 503, 503, 200]
+    gaps = [later - earlier for earlier, later in zip(times, times[1:])]
+    assert gaps[0] >= 0.05
+    assert gaps[1] > gaps[0] * 1.5
+    assert gaps[2] > gaps[1] * 1.5
+
+def test_failed_upload_holds_back_the_ones_behind_it(stand_in_server, spool):
+    stand_in_server.statuses = [500]
+    spool.enqueue(stand_in_server.url, b"first", "image/jpeg")
+    spool.enqueue(stand_in_server.url, b"second", "image/jpeg")
+
+    session = requests.Session()
+    assert spool.send_batch(session) == (0, True)
+    assert spool.pending()[0] == 2
+    assert spool.send_batch(session) == (2, False)
+    assert [body for _, _, body, _ in stand_in_server.requests] == [b"first", b"first", b"second"]
+
+def test_rejected_uploads_are_dropped(stand_in_server, spool):
+    stand_in_server.statuses = [400]
+    spool.enqueue(stand_in_server.url, b"bad", "image/jpeg")
+    spool.enqueue(stand_in_server.url, b"good", "image/jpeg")
+
+    assert spool.send_batch(requests.Session()) == (2, False)
+    assert spool.pending() == (0, 0)
+
+def test_uploads_stay_spooled_while_the_server_is_unreachable(spool):
+    spool.enqueue("http://127.0.0.1:9/fertility_check.php", b"frame", "image/jpeg")
+
+    assert spool.send_batch(requests.Session()) == (0, True)
+    assert spool.pending() == (1, len(b"frame"))
+    attempts = spool.connection.execute("SELECT attempts FROM uploads").fetchone()[0]
+    assert attempts == 1
+
+def test_oldest_uploads_are_evicted_over_max_bytes(tmp_path):
+    spool = UploadSpool(str(tmp_path / "spool.sqlite3"), max_bytes=250)
+    for i in range(3):
+        spool.enqueue("http://127.0.0.1:9/", bytes([i]) * 100, "image/jpeg")
+
+    assert spool.pending() == (2, 200)
+    bodies = [row[0] for row in spool.connection.execute("SELECT body FROM uploads ORDER BY id")]
+    assert bodies == [bytes([1]) * 100, bytes([2]) * 100]
+
+def test_spooled_uploads_survive_a_restart(stand_in_server, tmp_path):
+    path = str(tmp_path / "spool.sqlite3")
+    UploadSpool(path).enqueue(stand_in_server.url, b"frame", "image/jpeg")
+
+    spool = UploadSpool(path)
+    assert spool.send_batch(requests.Session()) == (1, False)
+    assert [body for _, _, body, _ in stand_in_server.requests] == [b"frame"]
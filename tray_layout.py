@@ -0,0 +1,117 @@
+import os
+import json
+import numpy as np
+from config import get_setting
+
+# Tray geometries are read from this JSON file; see tray_layouts.example.json for the format
+TRAY_LAYOUTS_PATH = get_setting(
+    "processing", "tray_layouts",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "tray_layouts.json")
+)
+
+# Layout used when the config file is missing or has no entry for an incubator
+DEFAULT_ROWS = 7
+DEFAULT_COLUMNS = 8
+
+# Corner order expected in the config: top-left, top-right, bottom-right, bottom-left
+UNIT_SQUARE = np.array([[0.0, 0.0], [1.0, 0.0], [1.0, 1.0], [0.0, 1.0]])
+
+# Function to compute the perspective transform that maps the four tray corners onto the unit square
+def corner_homography(corners):
+    corners = np.asarray(corners, dtype=np.float64)
+    if corners.shape != (4, 2):
+        raise ValueError(f"Tray corners must be four [x, y] pairs, got {corners.tolist()}")
+
+    a = np.zeros((8, 8))
+    b = np.zeros(8)
+    for i, ((x, y), (u, v)) in enumerate(zip(corners, UNIT_SQUARE)):
+        a[2 * i] = [x, y, 1, 0, 0, 0, -u * x, -u * y]
+        a[2 * i + 1] = [0, 0, 0, x, y, 1, -v * x, -v * y]
+        b[2 * i] = u
+        b[2 * i + 1] = v
+    return np.append(np.linalg.solve(a, b), 1.0).reshape(3, 3)
+
+class TrayLayout:
+    def __init__(self, rows=DEFAULT_ROWS, columns=DEFAULT_COLUMNS, corners=None):
+        self.rows = int(rows)
+        self.columns = int(columns)
+        # Calibrated tray corners as fractions of the image width/height, or None for the full frame
+        self.corners = corners
+        self.homography = corner_homography(corners) if corners is not None else None
+
+    def __repr__(self):
+        return f"TrayLayout(rows={self.rows}, columns={self.columns}, corners={self.corners})"
+
+    # Function to convert box centers (pixels) to tray coordinates in [0, 1] x [0, 1]
+    def tray_coordinates(self, centers, image_size):
+        img_width, img_height = image_size
+        points = centers / np.array([img_width, img_height], dtype=np.float64)
+        if self.homography is None:
+            return points
+
+        projected = np.hstack([points, np.ones((len(points), 1))]) @ self.homography.T
+        return projected[:, :2] / projected[:, 2:3]
+
+    # Function to assign every box to a tray cell in one pass
+    # xyxy is (N, 4) in pixels, conf and cls are (N,). Boxes whose center falls outside the
+    # calibrated tray are dropped; when several boxes share a cell the most confident one wins.
+    # Returns zero-based rows, columns, confidences and class ids of the winning boxes, row-major
+    def assign(self, xyxy, conf, cls, image_size):
+        xyxy = np.asarray(xyxy, dtype=np.float64).reshape(-1, 4)
+        conf = np.asarray(conf, dtype=np.float64).reshape(-1)
+        cls = np.asarray(cls).reshape(-1).astype(np.int64)
+        if len(xyxy) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, np.zeros(0), empty
+
+        centers = (xyxy[:, :2] + xyxy[:, 2:]) / 2
+        tray = self.tray_coordinates(centers, image_size)
+
+        inside = np.all((tray >= 0.0) & (tray <= 1.0), axis=1)
+        tray, conf, cls = tray[inside], conf[inside], cls[inside]
+
+        # Centers exactly on the right/bottom edge belong to the last column/row
+        cols = np.minimum((tray[:, 0] * self.columns).astype(np.int64), self.columns - 1)
+        rows = np.minimum((tray[:, 1] * self.rows).astype(np.int64), self.rows - 1)
+        cells = rows * self.columns + cols
+
+        # Sort by cell, then by descending confidence, and keep the first box of every cell
+        order = np.lexsort((-conf, cells))
+        _, first = np.unique(cells[order], return_index=True)
+        keep = order[first]
+        return rows[keep], cols[keep], conf[keep], cls[keep]
+
+# Function to build a TrayLayout from one entry of the config file
+def layout_from_config(entry):
+    return TrayLayout(
+        rows=entry.get("rows", DEFAULT_ROWS),
+        columns=entry.get("columns", DEFAULT_COLUMNS),
+        corners=entry.get("corners")
+    )
+
+# Function to load the default and per-incubator tray layouts from the config file
+def load_tray_layouts(path=TRAY_LAYOUTS_PATH):
+    layouts = {"default": TrayLayout()}
+    if not os.path.exists(path):
+        return layouts
+
+    try:
+        with open(path) as f:
+            config = json.load(f)
+        if "default" in config:
+            layouts["default"] = layout_from_config(config["default"])
+        for incubator, entry in config.get("incubators", {}).items():
+            layouts[incubator] = layout_from_config(entry)
+        print(f"Loaded tray layouts for {sorted(layouts)} from {path}")
+    except (OSError, ValueError, np.linalg.LinAlgError) as e:
+        print(f"Error loading tray layouts from {path}, using the default {DEFAULT_ROWS}x{DEFAULT_COLUMNS} grid: {str(e)}")
+    return layouts
+
+_layouts = None
+
+# Function to get the tray layout of an incubator, falling back to the default layout
+def get_tray_layout(incubator=None):
+    global _layouts
+    if _layouts is None:
+        _layouts = load_tray_layouts()
+    return _layouts.get(incubator, _layouts["default"])
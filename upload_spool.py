@@ -0,0 +1,152 @@
+import time
+import sqlite3
+import logging
+import threading
+import requests
+import metrics
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_LATENCY = metrics.histogram("intelliegg_upload_seconds", "Time taken by one upload POST, including failed ones")
+UPLOADS_SENT = metrics.counter("intelliegg_uploads_sent_total", "Uploads delivered (or rejected) by the server")
+UPLOADS_FAILED = metrics.counter("intelliegg_uploads_failed_total", "Upload attempts that will be retried")
+UPLOADS_EVICTED = metrics.counter("intelliegg_uploads_evicted_total", "Spooled uploads dropped to stay under max_bytes")
+
+# Persistent store-and-forward queue for uploads
+# Every capture is written to a local SQLite file first; a background sender drains it over one
+# keep-alive session, retrying with exponential backoff while the server is unreachable.
+# When the bodies exceed max_bytes the oldest entries are evicted to bound disk usage.
+# Batching is storage-side only: batch_size entries are read and deleted together, but each one is
+# still its own POST, since fertility_check.php accepts one image per request
+class UploadSpool:
+    def __init__(self, path="upload_spool.sqlite3", max_bytes=200 * 1024 * 1024, batch_size=10,
+                 retry_delay=2.0, retry_max_delay=300.0, timeout=15.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.retry_max_delay = retry_max_delay
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stop_event = threading.Event()
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS uploads (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT NOT NULL,
+                content_type TEXT NOT NULL,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        self.connection.commit()
+
+    # Function to add one upload to the spool and wake the sender
+    def enqueue(self, url, body, content_type):
+        with self.lock:
+            cursor = self.connection.execute(
+                "INSERT INTO uploads (url, content_type, body, size, created) VALUES (?, ?, ?, ?, ?)",
+                (url, content_type, sqlite3.Binary(body), len(body), time.time())
+            )
+            self._evict_oldest()
+            self.connection.commit()
+        self.wake.set()
+        return cursor.lastrowid
+
+    # Function to drop the oldest entries until the spooled bodies fit in max_bytes
+    def _evict_oldest(self):
+        total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM uploads").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = 0
+        for upload_id, size in self.connection.execute("SELECT id, size FROM uploads ORDER BY id").fetchall():
+            if total <= self.max_bytes:
+                break
+            self.connection.execute("DELETE FROM uploads WHERE id = ?", (upload_id,))
+            total -= size
+            evicted += 1
+        UPLOADS_EVICTED.inc(evicted)
+        logger.warning(f"Upload spool over {self.max_bytes} bytes, evicted the {evicted} oldest entries")
+
+    # Function to get the number of spooled uploads and their total size in bytes
+    def pending(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM uploads").fetchone()
+
+    # Function to read the next batch of uploads, oldest first
+    def _next_batch(self):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT id, url, content_type, body FROM uploads ORDER BY id LIMIT ?", (self.batch_size,)
+            ).fetchall()
+
+    # Function to remove sent (or undeliverable) uploads in one transaction
+    def _delete(self, upload_ids):
+        with self.lock:
+            self.connection.executemany("DELETE FROM uploads WHERE id = ?", [(i,) for i in upload_ids])
+            self.connection.commit()
+
+    # Function to count a failed attempt for an upload
+    def _record_attempt(self, upload_id):
+        with self.lock:
+            self.connection.execute("UPDATE uploads SET attempts = attempts + 1 WHERE id = ?", (upload_id,))
+            self.connection.commit()
+
+    # Function to send the next batch_size entries one POST each, deleting the sent ones in one transaction
+    # Returns (sent, failed) where failed means the server should be retried later
+    def send_batch(self, session):
+        batch = self._next_batch()
+        done = []
+        failed = False
+        for upload_id, url, content_type, body in batch:
+            try:
+                with UPLOAD_LATENCY.time():
+                    response = session.post(url, data=body, headers={'Content-Type': content_type}, timeout=self.timeout)
+                if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+                    # The server rejected this upload itself; sending it again will not help
+                    logger.error(f"Upload {upload_id} rejected with HTTP {response.status_code}, dropping it: {response.text[:200]}")
+                else:
+                    response.raise_for_status()
+                    logger.info(f"Upload {upload_id} sent: {response.text[:200]}")
+                done.append(upload_id)
+                UPLOADS_SENT.inc()
+            except requests.exceptions.RequestException as e:
+                logger.error(f"Upload {upload_id} failed: {e}")
+                UPLOADS_FAILED.inc()
+                self._record_attempt(upload_id)
+                failed = True
+                break  # Keep the order; everything behind this entry waits for the retry
+        if done:
+            self._delete(done)
+        return len(done), failed
+
+    # Sender loop: drains the spool, backing off exponentially while uploads fail
+    def run_sender(self):
+        session = requests.Session()
+        delay = self.retry_delay
+        while not self.stop_event.is_set():
+            sent, failed = self.send_batch(session)
+            if failed:
+                logger.info(f"Retrying spooled uploads in {delay:.0f}s")
+                self.stop_event.wait(delay)
+                delay = min(delay * 2, self.retry_max_delay)
+            elif sent:
+                delay = self.retry_delay
+            else:
+                self.wake.wait(timeout=60)
+                self.wake.clear()
+
+    # Function to start the sender in a background thread
+    def start(self):
+        thread = threading.Thread(target=self.run_sender, daemon=True)
+        thread.start()
+        return thread
+
+    # Function to stop the sender; spooled uploads stay on disk for the next run
+    def stop(self):
+        self.stop_event.set()
+        self.wake.set()
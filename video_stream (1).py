@@ -1,28 +1,91 @@
 import cv2
-from picamera2 import Picamera2
+from picamera2 import Picamera2, MappedArray
+from picamera2.encoders import H264Encoder, JpegEncoder
+from picamera2.outputs import FileOutput
+import numpy as np
+import queue
 import subprocess
 import time
 import signal
 import sys
 import io
 import base64
-import requests
 import threading
 from datetime import datetime, timedelta
 import os
+import json
+from config import get_setting
+from upload_spool import UploadSpool
+from capture_hub import USE_HUB, HUB_NAME, HubReader
+from frame_analysis import frame_quality, jpeg_quality, pick_best_frame
+import metrics
 
 RTMP_URL = "rtmp://a.rtmp.youtube.com/live2"
 STREAM_KEY = "79p6-8hqp-whhs-tmuk-cv2w"
 
+# What is fed to ffmpeg: with use_hub the capture hub's JPEG frames are always piped in as "mjpeg";
+# otherwise "raw" pushes bgr24 frames through the frame pump and lets ffmpeg encode them,
+# "h264" hands it the camera's hardware H.264 stream (copied, not re-encoded), and "mjpeg" the
+# hardware JPEG stream (re-encoded to H.264 by ffmpeg)
+RTMP_INPUT = "mjpeg" if USE_HUB else get_setting("rtmp", "rtmp_input", "raw")
+FRAME_SIZE = (640, 360)
+STREAM_FPS = get_setting("rtmp", "stream_fps", 30, int)
+H264_BITRATE = get_setting("rtmp", "h264_bitrate", 1000000, int)
+
+# Raw mode: number of preallocated frame buffers shared by the capture and writer threads. When all of
+# them are waiting for ffmpeg, new frames are dropped instead of stalling the camera
+FRAME_RING_SIZE = get_setting("rtmp", "frame_ring_size", 4, int)
+PUMP_STATS_INTERVAL = get_setting("rtmp", "pump_stats_interval", 60.0, float)
+
+FRAMES_WRITTEN = metrics.counter("intelliegg_rtmp_frames_written_total", "Frames written to ffmpeg")
+FRAMES_DROPPED = metrics.counter("intelliegg_rtmp_frames_dropped_total", "Frames dropped because ffmpeg was behind")
+FRAMES_LATE = metrics.counter("intelliegg_rtmp_frames_late_total", "Raw frames written more than two frame intervals after capture")
+
+# Daily captures are spooled to CAPTURE_SPOOL_PATH and posted from there, so a capture taken while
+# intelliegg.site is unreachable is delivered later instead of lost
+CAPTURE_URL = get_setting("capture", "capture_url", "http://intelliegg.site/webpages/fertility_check.php")
+CAPTURE_SPOOL_PATH = get_setting("capture", "capture_spool_path", "capture_spool.sqlite3")
+CAPTURE_SPOOL_MAX_BYTES = get_setting("capture", "capture_spool_max_bytes", 100 * 1024 * 1024, int)
+
+# capture_mode = store writes the daily capture to the local image store and inserts its images row
+# directly, instead of posting the base64 JPEG (see image_store.py)
+CAPTURE_MODE = get_setting("capture", "capture_mode", "post")
+
+# Incubator this camera watches, sent with every capture and stored in images.incubatorNo
+INCUBATOR = get_setting("processing", "incubator", "incubator1")
+
+# Scheduled captures: CAPTURE_SCHEDULE lists capture times per incubator, e.g.
+# "incubator1=08:00,20:00; incubator2=08:30". Every entry is captured from this camera and labelled
+# with its incubator. The last capture per incubator is kept locally in CAPTURE_STATE_PATH, so a
+# slot missed while the Pi was off is caught up once at the next start, and a failed capture is
+# retried every CAPTURE_RETRY_DELAY seconds instead of waiting for the next day
+CAPTURE_SCHEDULE = get_setting("capture", "capture_schedule", f"{INCUBATOR}=00:00")
+CAPTURE_STATE_PATH = get_setting("capture", "capture_state_path", "capture_state.json")
+CAPTURE_RETRY_DELAY = get_setting("capture", "capture_retry_delay", 60.0, float)
+
+# Each capture grabs CAPTURE_BURST_SIZE frames CAPTURE_BURST_INTERVAL seconds apart from the running
+# stream and only the sharpest, best exposed one is uploaded
+CAPTURE_BURST_SIZE = get_setting("capture", "capture_burst_size", 5, int)
+CAPTURE_BURST_INTERVAL = get_setting("capture", "capture_burst_interval", 0.2, float)
+
+capture_spool = UploadSpool(CAPTURE_SPOOL_PATH, CAPTURE_SPOOL_MAX_BYTES)
+capture_spool.start()
+
+if CAPTURE_MODE == "store":
+    from database import DatabasePool
+    from image_store import ImageStore, save_frame
+    store_db = DatabasePool()
+    image_store = ImageStore()
+
 def initialize_camera():
     retries = 5
     delay = 2  # seconds between retries
     for i in range(retries):
         try:
             picam2 = Picamera2()
-            picam2.preview_configuration.main.size = (640, 360)
-            picam2.preview_configuration.main.format = 'RGB888'
-            picam2.configure("preview")
+            picam2.configure(picam2.create_video_configuration(
+                main={"size": FRAME_SIZE, "format": 'RGB888'}, controls={"FrameRate": STREAM_FPS}
+            ))
             picam2.start()
             time.sleep(2)  # Warm-up time
             return picam2
@@ -31,82 +94,286 @@ def initialize_camera():
             time.sleep(delay)
     raise RuntimeError("Failed to initialize camera after multiple retries")
 
-picam2 = initialize_camera()
+if USE_HUB:
+    picam2 = None
+    hub = HubReader(HUB_NAME)
+else:
+    picam2 = initialize_camera()
+    hub = None
 
-def start_ffmpeg():
+def start_ffmpeg(input_mode=RTMP_INPUT):
+    x264 = ['-c:v', 'libx264', '-preset', 'ultrafast', '-tune', 'zerolatency', '-b:v', '1000k', '-bufsize', '64k', '-g', '15']
+    if input_mode == "h264":
+        video = ['-f', 'h264', '-framerate', str(STREAM_FPS), '-i', '-']
+        codec = ['-c:v', 'copy']
+    elif input_mode == "mjpeg":
+        video = ['-f', 'mjpeg', '-framerate', str(STREAM_FPS), '-i', '-']
+        codec = x264
+    else:
+        video = ['-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{FRAME_SIZE[0]}x{FRAME_SIZE[1]}', '-r', str(STREAM_FPS), '-i', '-']
+        codec = x264
     ffmpeg_cmd = [
         'ffmpeg',
         '-re',
         '-ar', '44100', '-ac', '2', '-f', 's16le', '-i', '/dev/zero',
-        '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', '640x360', '-r', '30', '-i', '-',
-        '-c:v', 'libx264', '-preset', 'ultrafast', '-tune', 'zerolatency', '-b:v', '1000k', '-bufsize', '64k',
-        '-g', '15',
+        *video,
+        *codec,
         '-c:a', 'aac', '-b:a', '64k', '-f', 'flv', f'{RTMP_URL}/{STREAM_KEY}'
     ]
     return subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE)
 
 ffmpeg_process = start_ffmpeg()
 
+# Raw frame pump between the camera and ffmpeg
+# The capture thread copies each frame straight from the camera buffer into a free slot of a
+# preallocated ring; the writer thread hands filled slots to ffmpeg's stdin as memoryviews, so no
+# per-frame bytes object is created. When ffmpeg falls behind and no slot is free, the new frame is
+# dropped and the camera keeps running
+class FramePump:
+    def __init__(self, picam2, stdin, ring_size=FRAME_RING_SIZE, fps=STREAM_FPS):
+        self.picam2 = picam2
+        self.stdin = stdin
+        self.frame_interval = 1.0 / fps
+        self.ring = [np.empty((FRAME_SIZE[1], FRAME_SIZE[0], 3), dtype=np.uint8) for _ in range(ring_size)]
+        self.captured_at = [0.0] * ring_size
+        self.free_slots = queue.Queue()
+        for slot in range(ring_size):
+            self.free_slots.put(slot)
+        self.ready_slots = queue.Queue()
+        self.stop_event = threading.Event()
+        self.written = 0
+        self.dropped = 0
+        self.late = 0
+
+    def capture_loop(self):
+        try:
+            while not self.stop_event.is_set():
+                request = self.picam2.capture_request()
+                try:
+                    try:
+                        slot = self.free_slots.get_nowait()
+                    except queue.Empty:
+                        self.dropped += 1
+                        FRAMES_DROPPED.inc()
+                        continue
+                    with MappedArray(request, "main") as m:
+                        np.copyto(self.ring[slot], m.array)
+                    self.captured_at[slot] = time.monotonic()
+                    self.ready_slots.put(slot)
+                finally:
+                    request.release()
+        except Exception as e:
+            print(f"Error in frame capture: {e}")
+            self.stop_event.set()
+        finally:
+            self.ready_slots.put(None)  # Wake the writer so it can exit
+
+    def write_loop(self):
+        while True:
+            slot = self.ready_slots.get()
+            if slot is None:
+                break
+            try:
+                if time.monotonic() - self.captured_at[slot] > 2 * self.frame_interval:
+                    self.late += 1
+                    FRAMES_LATE.inc()
+                self.stdin.write(memoryview(self.ring[slot]).cast('B'))
+                self.written += 1
+                FRAMES_WRITTEN.inc()
+            except (OSError, ValueError) as e:
+                print(f"Error writing frame to ffmpeg: {e}")
+                self.stop_event.set()
+                break
+            finally:
+                self.free_slots.put(slot)
+
+    def start(self):
+        for target in (self.capture_loop, self.write_loop):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def stats(self):
+        return {'written': self.written, 'dropped': self.dropped, 'late': self.late}
+
+# Function to copy the hub's frames into ffmpeg's stdin
+# Only the newest frame is ever written, so while ffmpeg is slow intermediate frames are skipped
+def pump_hub_frames(hub, stdin):
+    last_sequence = hub.sequence
+    while True:
+        sequence, frame = hub.wait_for_frame(last_sequence, timeout=5)
+        if frame is None:
+            continue
+        if last_sequence and sequence - last_sequence > 1:
+            FRAMES_DROPPED.inc(sequence - last_sequence - 1)
+        last_sequence = sequence
+        try:
+            stdin.write(frame)
+            FRAMES_WRITTEN.inc()
+        except (OSError, ValueError) as e:
+            print(f"Error writing frame to ffmpeg: {e}")
+            return
+
+# Function to grab a burst from the running stream and return (jpeg, (sharpness, exposure)) of its best frame
+# Hub frames are already JPEGs and are scored from a reduced decode; camera frames are scored as
+# captured and only the chosen one is encoded
+def grab_best_jpeg(burst_size=CAPTURE_BURST_SIZE, interval=CAPTURE_BURST_INTERVAL):
+    if hub:
+        frames = []
+        last_sequence = hub.sequence
+        for i in range(burst_size):
+            sequence, frame = hub.wait_for_frame(last_sequence, timeout=5)
+            if frame is None:
+                break
+            frames.append(frame)
+            last_sequence = sequence
+            if i < burst_size - 1:
+                time.sleep(interval)
+        if not frames:
+            raise RuntimeError("No frame from the capture hub")
+        scores = [jpeg_quality(frame) for frame in frames]
+        best = pick_best_frame(scores)
+        if best is None:
+            best = len(frames) - 1
+        return frames[best], scores[best] or (0.0, 0.0)
+
+    images = []
+    for i in range(burst_size):
+        images.append(picam2.capture_array())
+        if i < burst_size - 1:
+            time.sleep(interval)
+    scores = [frame_quality(cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)) for im in images]
+    best = pick_best_frame(scores)
+    ok, image_data = cv2.imencode('.jpg', images[best])
+    if not ok:
+        raise RuntimeError("Failed to encode captured frame")
+    return image_data, scores[best]
+
+frame_pump = None
+
 def cleanup():
     print('Cleaning up...')
+    if frame_pump:
+        frame_pump.stop()
     if picam2:
-        picam2.stop()
+        if RTMP_INPUT == "raw":
+            picam2.stop()
+        else:
+            picam2.stop_recording()
     if ffmpeg_process:
         ffmpeg_process.stdin.close()
         ffmpeg_process.terminate()
         ffmpeg_process.wait()
-    cv2.destroyAllWindows()
     sys.exit(0)
 
 signal.signal(signal.SIGINT, lambda sig, frame: cleanup())
 signal.signal(signal.SIGTERM, lambda sig, frame: cleanup())
 
-def check_entry_exists():
+# Function to parse CAPTURE_SCHEDULE into (incubator, hour, minute) entries
+def parse_capture_schedule(schedule=CAPTURE_SCHEDULE):
+    entries = []
+    for part in schedule.split(";"):
+        incubator, _, times = part.partition("=")
+        for value in times.split(","):
+            if value.strip():
+                hour, minute = (int(number) for number in value.strip().split(":"))
+                entries.append((incubator.strip(), hour, minute))
+    return entries
+
+# Function to read the last capture time per incubator, or an empty state on the first start
+def load_capture_state(path=CAPTURE_STATE_PATH):
     try:
-        current_date = datetime.now().date().isoformat()
-        check_data = {'detection_date': current_date}
-        response = requests.post('http://intelliegg.site/webpages/check_entry.php', json=check_data)
-        response.raise_for_status()
-        return response.json().get('exists', False)
-    except Exception as e:
-        print(f"Error checking entry: {e}")
-        return True
-
-def capture_and_save_image():
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"Error reading capture state from {path}: {e}")
+        return {}
+
+# Function to persist the capture state atomically
+def save_capture_state(state, path=CAPTURE_STATE_PATH):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(temp_path, path)
+
+# Function to get the latest scheduled time at or before now
+def last_scheduled(hour, minute, now):
+    slot = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    return slot if slot <= now else slot - timedelta(days=1)
+
+# Function to get the incubators with a scheduled time since their last capture
+def due_captures(entries, state, now):
+    due = []
+    for incubator, hour, minute in entries:
+        last_capture = state.get(incubator)
+        if incubator not in due and (last_capture is None or datetime.fromisoformat(last_capture) < last_scheduled(hour, minute, now)):
+            due.append(incubator)
+    return due
+
+# Function to upload one capture through the spool, or write it to the image store
+def submit_capture(image_data, incubator, captured_at):
+    if CAPTURE_MODE == "store":
+        image_id = save_frame(store_db, image_store, bytes(image_data), captured_at.strftime("%Y-%m-%d %H:%M:%S"), incubator)
+        print(f"Image for {incubator} stored as image {image_id}")
+        return
+    image_b64 = base64.b64encode(image_data).decode('utf-8')
+    data = {'image': image_b64, 'detection_date': captured_at.isoformat(), 'incubator': incubator}
+    capture_spool.enqueue(CAPTURE_URL, json.dumps(data).encode('utf-8'), 'application/json')
+    print(f"Image for {incubator} queued for upload")
+
+# Capture loop: takes every due capture, then sleeps until the next scheduled time
+def run_capture_scheduler(entries):
+    if not entries:
+        print("No capture times configured")
+        return
+    state = load_capture_state()
     while True:
-        try:
-            if not check_entry_exists():
-                im = picam2.capture_array()
-                temp_file = "/tmp/camera_frame.jpg"
-                cv2.imwrite(temp_file, im)
-
-                with open(temp_file, "rb") as f:
-                    image_data = f.read()
-                image_b64 = base64.b64encode(image_data).decode('utf-8')
-
-                data = {'image': image_b64, 'detection_date': datetime.now().isoformat()}
-                response = requests.post('http://intelliegg.site/webpages/fertility_check.php', json=data)
-                response.raise_for_status()
-                print(response.text)
-
-                os.remove(temp_file)
-            else:
-                print("Image for this date already exists.")
-        except Exception as e:
-            print(f"Error capturing and saving image: {e}")
+        now = datetime.now()
+        for incubator in due_captures(entries, state, now):
+            try:
+                image_data, (sharpness, exposure) = grab_best_jpeg()
+                submit_capture(image_data, incubator, now)
+                state[incubator] = now.isoformat()
+                save_capture_state(state)
+                print(f"Captured {incubator} (sharpness {sharpness:.0f}, exposure {exposure:.2f})")
+            except Exception as e:
+                print(f"Error capturing image for {incubator}: {e}")
 
-        time.sleep((24 * 60 * 60) - (datetime.now().second + datetime.now().minute * 60 + datetime.now().hour * 3600))
+        now = datetime.now()
+        if due_captures(entries, state, now):
+            delay = CAPTURE_RETRY_DELAY
+        else:
+            delay = min((last_scheduled(hour, minute, now) + timedelta(days=1) - now).total_seconds()
+                        for _, hour, minute in entries)
+        time.sleep(min(max(delay, 1), 3600))  # Re-check at least hourly in case the clock is adjusted
 
-image_capture_thread = threading.Thread(target=capture_and_save_image)
+image_capture_thread = threading.Thread(target=run_capture_scheduler, args=(parse_capture_schedule(),))
 image_capture_thread.daemon = True
 image_capture_thread.start()
 
 try:
-    while True:
-        im = picam2.capture_array()
-        ffmpeg_process.stdin.write(im.tobytes())
-        if cv2.waitKey(1) == ord('q'):
+    if hub:
+        threading.Thread(target=pump_hub_frames, args=(hub, ffmpeg_process.stdin), daemon=True).start()
+    elif RTMP_INPUT == "raw":
+        frame_pump = FramePump(picam2, ffmpeg_process.stdin)
+        frame_pump.start()
+    else:
+        # The camera's hardware encoder writes straight into ffmpeg's stdin
+        encoder = H264Encoder(bitrate=H264_BITRATE, repeat=True, iperiod=15) if RTMP_INPUT == "h264" else JpegEncoder()
+        picam2.start_encoder(encoder, FileOutput(ffmpeg_process.stdin))
+
+    while ffmpeg_process.poll() is None:
+        if frame_pump is None:
+            time.sleep(PUMP_STATS_INTERVAL)
+            continue
+        if frame_pump.stop_event.wait(PUMP_STATS_INTERVAL):
             break
+        print(f"Frame pump: {frame_pump.stats()}")
+    print("Stream stopped")
 except Exception as e:
     print(f"Error in main loop: {e}")
 finally:
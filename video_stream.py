@@ -15,11 +15,59 @@ import requests
 import numpy as np
 import os
 import sys
+import json
+from datetime import datetime
+from config import get_setting
+from async_streaming import AsyncStreamingServer
+from frame_analysis import ChangeDetector
+from tray_layout import get_tray_layout
+from upload_spool import UploadSpool
+from capture_hub import USE_HUB, HUB_NAME, HubReader
+import metrics
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# Frame upload settings. UPLOAD_MODE "binary" posts the JPEG bytes as the request body,
+# "multipart" as an "image" file field, and "json" keeps the base64 JSON body that the
+# existing fertility_check.php expects. "store" skips HTTP: the frame goes into the local image
+# store and only its hash, size and thumbnail are inserted into images (see image_store.py)
+UPLOAD_URL = get_setting("stream", "upload_url", "http://192.168.0.101/Thesis-Intelliegg/webpages/fertility_check.php")
+UPLOAD_MODE = get_setting("stream", "upload_mode", "json")
+UPLOAD_INTERVAL = get_setting("stream", "upload_interval", 60.0, float)
+UPLOAD_TIMEOUT = get_setting("stream", "upload_timeout", 15.0, float)
+
+# Every upload is spooled to SPOOL_PATH first and sent from there by a background sender,
+# so frames captured while the server is unreachable are delivered later instead of lost
+SPOOL_PATH = get_setting("stream", "spool_path", "upload_spool.sqlite3")
+SPOOL_MAX_BYTES = get_setting("stream", "spool_max_bytes", 200 * 1024 * 1024, int)
+
+# Change-driven uploads: each interval the latest frame is compared with the last uploaded one and
+# only sent when the thumbnail difference reaches CHANGE_THRESHOLD gray levels, or when nothing
+# was uploaded for HEARTBEAT_INTERVAL seconds. Set upload_on_change = false to upload every interval
+UPLOAD_ON_CHANGE = get_setting("stream", "upload_on_change", True, bool)
+CHANGE_THRESHOLD = get_setting("stream", "change_threshold", 6.0, float)
+HEARTBEAT_INTERVAL = get_setting("stream", "heartbeat_interval", 900.0, float)
+
+# Maximum number of concurrent /stream.mjpg viewers; further viewers get 503 Service Unavailable
+MAX_VIEWERS = get_setting("stream", "max_viewers", 8, int)
+
+# "threaded" serves every viewer from its own thread; "asyncio" serves all of them from one event
+# loop thread, with at most CLIENT_BUFFER_BYTES of unsent data queued per viewer
+SERVER_MODE = get_setting("stream", "server_mode", "threaded")
+CLIENT_BUFFER_BYTES = get_setting("stream", "client_buffer_bytes", 256 * 1024, int)
+
+# Optional on-device inference on the live stream. Per-cell results are posted to LIVE_RESULTS_URL
+# whenever a cell's status changes, and at least every LIVE_RESULTS_INTERVAL seconds otherwise.
+# LIVE_OVERLAY draws the latest boxes onto the frames sent to /stream.mjpg viewers only; uploads,
+# change detection and live inference keep reading the camera's own frames
+LIVE_INFERENCE = get_setting("stream", "live_inference", False, bool)
+LIVE_RESULTS_URL = get_setting("stream", "live_results_url", "http://192.168.0.101/Thesis-Intelliegg/webpages/live_results.php")
+LIVE_RESULTS_INTERVAL = get_setting("stream", "live_results_interval", 60.0, float)
+LIVE_OVERLAY = get_setting("stream", "live_overlay", False, bool)
+INCUBATOR = get_setting("processing", "incubator", "incubator1")
+
 PAGE = """
 <html>
 <head>
@@ -32,15 +80,38 @@ PAGE = """
 </html>
 """
 
+FRAMES_RECEIVED = metrics.counter("intelliegg_camera_frames_total", "Encoded frames received from the camera")
+FRAME_INTERVAL = metrics.histogram("intelliegg_camera_frame_interval_seconds", "Time between consecutive camera frames")
+
 class StreamingOutput(io.BufferedIOBase):
-    def __init__(self):
+    def __init__(self, record_metrics=True):
         self.frame = None
+        self.sequence = 0  # Incremented for every frame, so readers can tell how many they missed
         self.condition = Condition()
+        self.last_write = None
+        self.record_metrics = record_metrics  # Off for outputs fed from another output, not the camera
 
     def write(self, buf):
+        now = time.perf_counter()
         with self.condition:
             self.frame = buf
+            self.sequence += 1
             self.condition.notify_all()
+        if not self.record_metrics:
+            return
+        FRAMES_RECEIVED.inc()
+        if self.last_write is not None:
+            FRAME_INTERVAL.observe(now - self.last_write)
+        self.last_write = now
+
+    # Function to wait for a frame newer than last_sequence
+    # Returns (sequence, frame), or (last_sequence, None) on timeout. Only the latest frame is
+    # kept, so a reader that fell behind skips straight to it instead of blocking the camera
+    def wait_for_frame(self, last_sequence, timeout=None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.sequence != last_sequence, timeout):
+                return last_sequence, None
+            return self.sequence, self.frame
 
 class StreamingHandler(server.BaseHTTPRequestHandler):
     def do_GET(self):
@@ -56,6 +127,10 @@ class StreamingHandler(server.BaseHTTPRequestHandler):
             self.end_headers()
             self.wfile.write(content)
         elif self.path == '/stream.mjpg':
+            stats = self.server.add_viewer(self.client_address)
+            if stats is None:
+                self.send_error(503, f"Too many viewers (limit {self.server.max_viewers})")
+                return
             self.send_response(200)
             self.send_header('Age', 0)
             self.send_header('Cache-Control', 'no-cache, private')
@@ -63,26 +138,200 @@ class StreamingHandler(server.BaseHTTPRequestHandler):
             self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
             self.end_headers()
             try:
+                last_sequence = viewer_output.sequence
                 while True:
-                    with output.condition:
-                        output.condition.wait()
-                        frame = output.frame
-                        self.wfile.write(b'--FRAME\r\n')
-                        self.send_header('Content-Type', 'image/jpeg')
-                        self.send_header('Content-Length', len(frame))
-                        self.end_headers()
-                        self.wfile.write(frame)
-                        self.wfile.write(b'\r\n')
+                    sequence, frame = viewer_output.wait_for_frame(last_sequence, timeout=5)
+                    if frame is None:
+                        continue
+                    stats['frames_dropped'] += sequence - last_sequence - 1
+                    last_sequence = sequence
+
+                    # Written without holding the output's lock, so a slow viewer only delays itself
+                    self.wfile.write(b'--FRAME\r\n')
+                    self.send_header('Content-Type', 'image/jpeg')
+                    self.send_header('Content-Length', len(frame))
+                    self.end_headers()
+                    self.wfile.write(frame)
+                    self.wfile.write(b'\r\n')
+                    stats['frames_sent'] += 1
             except Exception as e:
                 logger.error(f"Removed streaming client {self.client_address}: {e}")
+            finally:
+                self.server.remove_viewer(self.client_address)
+        elif self.path == '/stats':
+            content = json.dumps(self.server.viewer_stats()).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', len(content))
+            self.end_headers()
+            self.wfile.write(content)
+        elif self.path == '/metrics':
+            content = metrics.REGISTRY.render_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', len(content))
+            self.end_headers()
+            self.wfile.write(content)
         else:
             self.send_error(404)
             self.end_headers()
 
+# Function to build the upload body for one encoded JPEG frame, returning (body, content_type)
+# The frame is the JpegEncoder output buffer as-is; only "json" mode re-encodes it (as base64)
+def encode_upload(frame, mode=UPLOAD_MODE):
+    if mode == "binary":
+        return bytes(frame), 'image/jpeg'
+    if mode == "multipart":
+        files = {'image': ('camera_frame.jpg', frame, 'image/jpeg')}
+        prepared = requests.Request('POST', UPLOAD_URL, files=files, data={'incubator': INCUBATOR}).prepare()
+        return prepared.body, prepared.headers['Content-Type']
+
+    image_b64 = base64.b64encode(frame).decode('utf-8')
+    return json.dumps({'image': image_b64, 'incubator': INCUBATOR}).encode('utf-8'), 'application/json'
+
+# Function to keep a frame in the image store and register it in images ("store" upload mode)
+# Returns whether the frame was stored
+def store_frame(db, store, frame):
+    try:
+        image_id = save_frame(db, store, bytes(frame), datetime.now().strftime("%Y-%m-%d %H:%M:%S"), INCUBATOR)
+        logger.info(f"Stored frame as image {image_id}")
+        return True
+    except Exception as e:
+        logger.error(f"Storing frame failed: {e}")
+        return False
+
+# Worker thread running the egg model on the live stream
+# It always takes the newest frame from StreamingOutput (frames that arrive while it is busy are
+# skipped, never queued), so results lag the camera by about one inference time
+class LiveInferenceWorker(threading.Thread):
+    def __init__(self, output, session):
+        super().__init__(daemon=True)
+        self.output = output
+        self.session = session
+        self.boxes = []  # Latest (x1, y1, x2, y2, class_id) boxes, read by OverlayRenderer
+        self.last_statuses = None
+        self.last_post = 0
+        self.frames_inferred = 0
+        self.frames_skipped = 0
+
+    def run(self):
+        # Imported here so the stream does not need the processing dependencies unless this is enabled
+        import image_processing
+        model = image_processing.load_model(image_processing.MODEL_PATH)
+        if model is None:
+            logger.error("Live inference disabled: model could not be loaded")
+            return
+        layout = get_tray_layout(INCUBATOR)
+
+        last_sequence = self.output.sequence
+        while True:
+            sequence, frame = self.output.wait_for_frame(last_sequence, timeout=5)
+            if frame is None:
+                continue
+            self.frames_skipped += sequence - last_sequence - 1
+            last_sequence = sequence
+
+            image = cv2.imdecode(np.frombuffer(frame, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if image is None:
+                continue
+            results = image_processing.predict_image(model, image)
+            if results is None:
+                continue
+            self.frames_inferred += 1
+
+            boxes = results[0].boxes
+            self.boxes = [
+                (*map(int, xyxy), int(class_id))
+                for xyxy, class_id in zip(boxes.xyxy.cpu().numpy(), boxes.cls.cpu().numpy())
+            ]
+            height, width = image.shape[:2]
+            egg_data = image_processing.map_results_to_grid(None, results, (width, height), None, layout)
+            self.post_results([[row, col, status, round(confidence, 3)] for _, row, col, status, confidence, _ in egg_data])
+
+    # Function to post the compact per-cell results when a status changed or the interval has passed
+    def post_results(self, cells):
+        statuses = [(row, col, status) for row, col, status, _ in cells]
+        if statuses == self.last_statuses and time.monotonic() - self.last_post < LIVE_RESULTS_INTERVAL:
+            return
+
+        data = {'incubator': INCUBATOR, 'detection_date': datetime.now().isoformat(), 'cells': cells}
+        try:
+            response = self.session.post(LIVE_RESULTS_URL, json=data, timeout=UPLOAD_TIMEOUT)
+            response.raise_for_status()
+            self.last_statuses = statuses
+            self.last_post = time.monotonic()
+            logger.info(f"Posted live results for {len(cells)} eggs "
+                        f"({self.frames_inferred} frames inferred, {self.frames_skipped} skipped)")
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Posting live results failed: {e}")
+
+# Thread drawing the latest live inference boxes onto the stream for /stream.mjpg viewers
+# The camera frames themselves are never touched: each new frame is decoded, annotated and re-encoded
+# into a separate output, once per frame however many viewers there are. It always takes the newest
+# frame, so a slow re-encode skips frames instead of delaying the camera; frames without boxes are
+# passed through as they are
+class OverlayRenderer(threading.Thread):
+    def __init__(self, source, worker):
+        super().__init__(daemon=True)
+        self.source = source
+        self.worker = worker
+        self.output = StreamingOutput(record_metrics=False)
+
+    def run(self):
+        last_sequence = self.source.sequence
+        while True:
+            sequence, frame = self.source.wait_for_frame(last_sequence, timeout=5)
+            if frame is None:
+                continue
+            last_sequence = sequence
+            self.output.write(self.annotate(frame))
+
+    # Function to draw the boxes onto a copy of an encoded frame, returning the new JPEG
+    def annotate(self, frame):
+        boxes = self.worker.boxes
+        if not boxes:
+            return frame
+        image = cv2.imdecode(np.frombuffer(frame, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            return frame
+        for x1, y1, x2, y2, class_id in boxes:
+            color = (0, 255, 0) if class_id == 0 else (0, 0, 255)  # BGR: green fertile, red infertile
+            cv2.rectangle(image, (x1, y1), (x2, y2), color, 2)
+        ok, jpeg = cv2.imencode('.jpg', image)
+        return jpeg.tobytes() if ok else frame
+
 class StreamingServer(socketserver.ThreadingMixIn, server.HTTPServer):
     allow_reuse_address = True
     daemon_threads = True
 
+    def __init__(self, address, handler, max_viewers=MAX_VIEWERS):
+        super().__init__(address, handler)
+        self.max_viewers = max_viewers
+        self.viewers = {}
+        self.viewers_lock = threading.Lock()
+
+    # Function to register a viewer, returning its stats dict or None when the viewer cap is reached
+    def add_viewer(self, client_address):
+        with self.viewers_lock:
+            if len(self.viewers) >= self.max_viewers:
+                logger.warning(f"Rejected streaming client {client_address}: {self.max_viewers} viewers already connected")
+                return None
+            stats = {'connected': time.time(), 'frames_sent': 0, 'frames_dropped': 0}
+            self.viewers[client_address] = stats
+            return stats
+
+    def remove_viewer(self, client_address):
+        with self.viewers_lock:
+            stats = self.viewers.pop(client_address, None)
+        if stats:
+            logger.info(f"Streaming client {client_address} sent {stats['frames_sent']} frames, "
+                        f"dropped {stats['frames_dropped']}")
+
+    # Function to get a snapshot of the per-viewer stats, keyed by "host:port"
+    def viewer_stats(self):
+        with self.viewers_lock:
+            return {f"{host}:{port}": dict(stats) for (host, port), stats in self.viewers.items()}
+
 def initialize_camera():
     for _ in range(3):  # Try 3 times to initialize the camera
         try:
@@ -95,53 +344,74 @@ def initialize_camera():
             time.sleep(2)  # Wait before retrying
     return None
 
-picam2 = initialize_camera()
-if picam2 is None:
-    logger.error("Failed to initialize camera. Exiting.")
-    sys.exit(1)
+if USE_HUB:
+    # The capture hub owns the camera; frames are read from its shared-memory ring
+    picam2 = None
+    try:
+        output = HubReader(HUB_NAME)
+    except FileNotFoundError:
+        logger.error(f"Capture hub {HUB_NAME} is not running. Exiting.")
+        sys.exit(1)
+else:
+    picam2 = initialize_camera()
+    if picam2 is None:
+        logger.error("Failed to initialize camera. Exiting.")
+        sys.exit(1)
+    output = StreamingOutput()
 
-output = StreamingOutput()
+# Viewers read viewer_output; everything else reads output
+viewer_output = output
 
 try:
-    picam2.start_recording(JpegEncoder(), FileOutput(output))
-
-    address = ('', 7123)
-    server = StreamingServer(address, StreamingHandler)
-    server_thread = threading.Thread(target=server.serve_forever)
-    server_thread.daemon = True
-    server_thread.start()
-
-    while True:
-        with output.condition:
-            output.condition.wait()
-            frame = output.frame
-
-        # Convert frame to NumPy array
-        if isinstance(frame, bytes):
-            frame = np.frombuffer(frame, dtype=np.uint8)
-            frame = cv2.imdecode(frame, cv2.IMREAD_COLOR)
+    if LIVE_INFERENCE:
+        live_worker = LiveInferenceWorker(output, requests.Session())
+        live_worker.start()
+        if LIVE_OVERLAY:
+            overlay = OverlayRenderer(output, live_worker)
+            overlay.start()
+            viewer_output = overlay.output
 
-        # Save the frame to a temporary file
-        temp_file = "/tmp/camera_frame.jpg"
-        cv2.imwrite(temp_file, frame)
+    if picam2:
+        picam2.start_recording(JpegEncoder(), FileOutput(output))
 
-        # Read the file contents and send to the PHP script
-        with open(temp_file, "rb") as f:
-            image_data = f.read()
-        image_b64 = base64.b64encode(image_data).decode('utf-8')
+    address = ('', 7123)
+    if SERVER_MODE == "asyncio":
+        AsyncStreamingServer(viewer_output, PAGE, address, MAX_VIEWERS, CLIENT_BUFFER_BYTES).start_in_thread()
+    else:
+        server = StreamingServer(address, StreamingHandler)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
 
-        data = {'image': image_b64}
+    if UPLOAD_MODE == "store":
+        # Imported here so the other modes do not need the database dependencies
+        from database import DatabasePool
+        from image_store import ImageStore, save_frame
+        store_db = DatabasePool()
+        image_store = ImageStore()
+    else:
+        spool = UploadSpool(SPOOL_PATH, SPOOL_MAX_BYTES, timeout=UPLOAD_TIMEOUT)
+        spool.start()  # Sends over one keep-alive connection
+    change_detector = ChangeDetector(CHANGE_THRESHOLD, HEARTBEAT_INTERVAL)
 
-        try:
-            response = requests.post('http://192.168.0.101/Thesis-Intelliegg/webpages/fertility_check.php', json=data)
-            response.raise_for_status()  # Raise an exception for HTTP errors
-            print(response.text)
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Request failed: {e}")
+    while True:
+        _, frame = output.wait_for_frame(output.sequence)
 
-        os.remove(temp_file)  # Remove the temporary file
+        should_upload, reason, score, thumbnail = change_detector.check(frame)
+        if UPLOAD_ON_CHANGE and not should_upload:
+            logger.debug(f"Skipping upload, tray unchanged (difference {score:.1f})")
+        else:
+            if UPLOAD_MODE == "store":
+                # A frame that failed to store is not the new reference, so the next check tries again
+                uploaded = store_frame(store_db, image_store, frame)
+            else:
+                spool.enqueue(UPLOAD_URL, *encode_upload(frame))
+                logger.info(f"Queued frame for upload ({reason})")
+                uploaded = True
+            if uploaded:
+                change_detector.mark_uploaded(thumbnail)
 
-        time.sleep(60)  # Check every minute
+        time.sleep(UPLOAD_INTERVAL)  # Check once per interval (a minute by default)
 
 except Exception as e:
     logger.error(f"An error occurred: {e}")